@@ -0,0 +1,354 @@
+"""
+HTTP benchmark for every route of the learning journal.
+
+Seeds a database with a configurable number of entries of realistic
+sizes, drives the WSGI app built by ``learning_journal_db.main`` in
+process, and reports p50/p95/p99 latency, throughput and peak RSS per
+route. Each route runs in a process forked from the seeded one (where
+the platform can fork), so its peak RSS, and how far that is above the
+RSS it started with, are its own rather than the high-water mark of
+seeding. Results are written as JSON and can be compared to a stored
+baseline; the exit status is 1 if any route's p95 regressed by more
+than the tolerance.
+
+Usage::
+
+    python benchmarks/routes.py --entries 100000 --output bench.json
+    python benchmarks/routes.py --baseline bench.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from webob import Request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from learning_journal_db import main  # noqa
+from learning_journal_db.models import User  # noqa
+from learning_journal_db.models.meta import Base  # noqa
+from learning_journal_db.scripts.adduser import set_user  # noqa
+from learning_journal_db.scripts.bulkdata import import_records  # noqa
+from learning_journal_db.security import hash_password  # noqa
+
+
+AUTH_SECRET = 'benchmark-secret'
+USERNAME = 'tw'
+
+WORDS = ('pyramid', 'python', 'heap', 'template', 'deploy', 'heroku',
+         'database', 'index', 'query', 'session', 'test', 'learned',
+         'today', 'about', 'the', 'and', 'with', 'a', 'of', 'to')
+
+
+def random_text(rng, mean_words):
+    """Return roughly ``mean_words`` words, log-normally distributed."""
+    count = max(1, int(rng.lognormvariate(0, 0.75) * mean_words))
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def seed_records(count, body_words, seed=0):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            'title': 'Day %d: %s' % (i, random_text(rng, 4)),
+            'body': random_text(rng, body_words),
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Route(object):
+    """A request template: ``make_request(rng)`` returns a webob Request."""
+
+    def __init__(self, name, make_request, count):
+        self.name = name
+        self.make_request = make_request
+        self.count = count
+
+
+def build_routes(args, max_id, auth_cookie):
+    def get(path):
+        request = Request.blank(path)
+        request.headers['Cookie'] = auth_cookie
+        return request
+
+    def post(path, params):
+        request = Request.blank(path, POST=params)
+        request.headers['Cookie'] = auth_cookie
+        return request
+
+    n = args.requests
+    return [
+        Route('GET /list', lambda rng: get('/list'), n),
+        Route('GET /list?after', lambda rng: get(
+            '/list?after=%d' % rng.randint(1, max_id)), n),
+        Route('GET /journal/{id}', lambda rng: get(
+            '/journal/%d' % rng.randint(1, max_id)), n),
+        Route('GET /journal/new-entry', lambda rng: get(
+            '/journal/new-entry'), n),
+        Route('POST /journal/new-entry', lambda rng: post(
+            '/journal/new-entry', {
+                'title': random_text(rng, 4),
+                'body': random_text(rng, args.body_words)}), n),
+        Route('GET /journal/{id}/edit-entry', lambda rng: get(
+            '/journal/%d/edit-entry' % rng.randint(1, max_id)), n),
+        Route('POST /journal/{id}/edit-entry', lambda rng: post(
+            '/journal/%d/edit-entry' % rng.randint(1, max_id), {
+                'title': random_text(rng, 4),
+                'body': random_text(rng, args.body_words)}), n),
+        Route('GET /login', lambda rng: Request.blank('/login'), n),
+        # Each check hashes a password on purpose, so keep these few.
+        Route('POST /login', lambda rng: Request.blank('/login', POST={
+            'username': USERNAME, 'password': 'not-the-password'}),
+            args.login_requests),
+    ]
+
+
+def run_route(app, route, concurrency, seed):
+    """Issue ``route.count`` requests; return latencies and wall time."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = [route.count // concurrency] * concurrency
+    for i in range(route.count % concurrency):
+        per_thread[i] += 1
+
+    def worker(thread_index, count):
+        rng = random.Random(seed * 1000 + thread_index)
+        local = []
+        for _ in range(count):
+            request = route.make_request(rng)
+            start = time.perf_counter()
+            response = request.get_response(app)
+            elapsed = time.perf_counter() - start
+            if response.status_code >= 400:
+                with lock:
+                    errors.append(response.status)
+            local.append(elapsed)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i, count))
+               for i, count in enumerate(per_thread) if count]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, errors
+
+
+def summarize(latencies, wall_time, errors):
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000.0, 3)  # noqa
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'throughput_rps': round(len(latencies) / wall_time, 1),
+    }
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure_route(app, route, concurrency, seed):
+    """Run ``route`` and return its summary, with its memory use."""
+    start_rss = peak_rss_kb()
+    summary = summarize(*run_route(app, route, concurrency, seed))
+    summary['peak_rss_kb'] = peak_rss_kb()
+    summary['rss_growth_kb'] = summary['peak_rss_kb'] - start_rss
+    return summary
+
+
+def measure_route_in_child(app, route, concurrency, seed):
+    """
+    Run ``measure_route`` in a forked process, whose peak RSS starts at
+    the RSS it was forked with, and return its summary.
+    """
+    if not hasattr(os, 'fork'):
+        # The peak is then the process's high-water mark so far.
+        return measure_route(app, route, concurrency, seed)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            # Pooled connections can't be shared with the parent.
+            app.registry['dbsession_factory'].kw['bind'].dispose(
+                close=False)
+            summary = measure_route(app, route, concurrency, seed)
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump(summary, f)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError('Benchmark of %s failed' % route.name)
+    return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of (route, metric, baseline, current) regressions."""
+    regressions = []
+    for name, current in results['routes'].items():
+        previous = baseline.get('routes', {}).get(name)
+        if not previous:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                (name, 'p95_ms', previous['p95_ms'], current['p95_ms']))
+        if current['throughput_rps'] < \
+                previous['throughput_rps'] * (1 - tolerance):
+            regressions.append((name, 'throughput_rps',
+                                previous['throughput_rps'],
+                                current['throughput_rps']))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entries', type=int, default=1000,
+                        help='entries to seed (e.g. 1000, 100000, 1000000)')
+    parser.add_argument('--body-words', type=int, default=300,
+                        help='mean words per entry body')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--login-requests', type=int, default=10,
+                        help='requests for POST /login')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='client threads per route')
+    parser.add_argument('--db-url',
+                        help='database to seed (default: temporary SQLite)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='KEY=VALUE', help='extra app setting')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression (default 0.2)')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    tmpdir = None
+    db_url = args.db_url
+    if db_url is None:
+        tmpdir = tempfile.mkdtemp(prefix='journal-bench-')
+        db_url = 'sqlite:///%s' % os.path.join(tmpdir, 'bench.sqlite')
+    os.environ['AUTH_SECRET'] = AUTH_SECRET
+    settings = {
+        'sqlalchemy.url': db_url,
+        # The benchmark hammers /login from one address on purpose.
+        'auth.throttle': 'false',
+    }
+    settings.update(s.split('=', 1) for s in args.setting)
+
+    try:
+        app = main({}, **settings)
+        session_factory = app.registry['dbsession_factory']
+        Base.metadata.create_all(session_factory.kw['bind'])
+        dbsession = session_factory()
+        # Logins are expected to fail; the hash just has to be valid.
+        set_user(dbsession, USERNAME, hash_password('benchmark'))
+        dbsession.commit()
+        owner_id = dbsession.query(User.id).scalar()
+        dbsession.close()
+        start = time.perf_counter()
+        import_records(session_factory,
+                       seed_records(args.entries, args.body_words, args.seed),
+                       owner_id, batch_size=5000)
+        seed_time = time.perf_counter() - start
+
+        from pyramid.authentication import AuthTicket
+        ticket = AuthTicket(AUTH_SECRET, USERNAME, '0.0.0.0',
+                            hashalg='sha512')
+        auth_cookie = 'auth_tkt=%s' % ticket.cookie_value()
+
+        results = {
+            'meta': {
+                'entries': args.entries,
+                'body_words': args.body_words,
+                'concurrency': args.concurrency,
+                'database': db_url.split(':', 1)[0],
+                'python': platform.python_version(),
+                'seed_seconds': round(seed_time, 2),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           time.gmtime()),
+            },
+            'routes': {},
+        }
+        for route in build_routes(args, args.entries, auth_cookie):
+            results['routes'][route.name] = measure_route_in_child(
+                app, route, args.concurrency, args.seed)
+        return results
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def print_table(results):
+    print('%-32s %8s %9s %9s %9s %9s %6s %8s %8s' % (
+        'route', 'reqs', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errs',
+        'peak MB', '+MB'))
+    for name, r in sorted(results['routes'].items()):
+        print('%-32s %8d %9.2f %9.2f %9.2f %9.1f %6d %8.1f %8.1f' % (
+            name, r['requests'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['throughput_rps'], r['errors'], r['peak_rss_kb'] / 1024.0,
+            r['rss_growth_kb'] / 1024.0))
+
+
+def main_cli(argv=sys.argv):
+    args = parse_args(argv[1:])
+    results = run(args)
+    print_table(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ('entries', 'body_words', 'concurrency', 'database'):
+            if baseline.get('meta', {}).get(key) != results['meta'][key]:
+                print('warning: baseline was run with %s=%s, not %s' % (
+                    key, baseline.get('meta', {}).get(key),
+                    results['meta'][key]))
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print('REGRESSION %s %s: %s -> %s' % (name, metric, before, after))
+        if regressions:
+            return 1
+        print('no regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,151 @@
+"""
+Cold start benchmark for the learning journal.
+
+Starts a fresh interpreter several times and reports, as medians, how
+long importing the package, building the WSGI app with
+``learning_journal_db.main`` and serving the first request take, along
+with the number of modules loaded. Results are written as JSON and can
+be compared to a stored baseline; the exit status is 1 if time to first
+request regressed by more than the tolerance.
+
+Usage::
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+    python benchmarks/startup.py --baseline startup.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+METRICS = ('interpreter_ms', 'import_ms', 'make_app_ms', 'first_request_ms',
+           'time_to_first_request_ms')
+
+
+def child(args):
+    """Run in the fresh interpreter: time one start, print JSON."""
+    start = time.perf_counter()
+    modules_before = len(sys.modules)
+    sys.path.insert(0, os.path.dirname(HERE))
+    from learning_journal_db import main
+    imported = time.perf_counter()
+
+    settings = {'sqlalchemy.url': args.db_url}
+    settings.update(s.split('=', 1) for s in args.setting)
+    app = main({}, **settings)
+    made = time.perf_counter()
+
+    from webob import Request
+    response = Request.blank(args.path).get_response(app)
+    served = time.perf_counter()
+
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000.0,
+        'make_app_ms': (made - imported) * 1000.0,
+        'first_request_ms': (served - made) * 1000.0,
+        'status': response.status_code,
+        'modules': len(sys.modules) - modules_before,
+    }))
+
+
+def run_once(args, db_url):
+    command = [sys.executable, os.path.abspath(__file__), '--child',
+               '--db-url', db_url, '--path', args.path]
+    for setting in args.setting:
+        command.extend(['--setting', setting])
+    env = dict(os.environ, AUTH_SECRET='benchmark-secret')
+    start = time.perf_counter()
+    output = subprocess.check_output(command, env=env)
+    wall = (time.perf_counter() - start) * 1000.0
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    in_process = (result['import_ms'] + result['make_app_ms'] +
+                  result['first_request_ms'])
+    # Everything before our first line ran: interpreter start and site.
+    # The process exit after the first request is included in it too.
+    result['interpreter_ms'] = wall - in_process
+    result['time_to_first_request_ms'] = wall
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='journal-startup-')
+    db_url = args.db_url or 'sqlite:///%s' % os.path.join(tmpdir, 'db.sqlite')
+    # One untimed start warms the OS file cache and writes bytecode.
+    run_once(args, db_url)
+    runs = [run_once(args, db_url) for _ in range(args.runs)]
+    statuses = set(r['status'] for r in runs)
+    results = {
+        'meta': {
+            'runs': args.runs,
+            'path': args.path,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'modules': runs[-1]['modules'],
+        'status': sorted(statuses),
+    }
+    for metric in METRICS:
+        results[metric] = round(median([r[metric] for r in runs]), 2)
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/login',
+                        help='path of the first request')
+    parser.add_argument('--db-url',
+                        help='database url (default: temporary SQLite)')
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='KEY=VALUE', help='extra app setting')
+    parser.add_argument('--output', default='startup_output.json')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression (default 0.2)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=sys.argv):
+    args = parse_args(argv[1:])
+    if args.child:
+        child(args)
+        return 0
+    results = run(args)
+    for metric in METRICS:
+        print('%-26s %9.1f ms' % (metric, results[metric]))
+    print('%-26s %9d' % ('modules imported', results['modules']))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        before = baseline['time_to_first_request_ms']
+        after = results['time_to_first_request_ms']
+        print('time to first request: %.1f ms -> %.1f ms (%+.0f%%)' % (
+            before, after, (after / before - 1) * 100))
+        if after > before * (1 + args.tolerance):
+            print('REGRESSION time_to_first_request_ms')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
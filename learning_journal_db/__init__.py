@@ -9,8 +9,13 @@ def main(global_config, **settings):
         settings['sqlalchemy.url'] = os.environ['DATABASE_URL']
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
+    config.include('.templating')
+    config.include('.compression')
+    config.include('.metrics')
     config.include('.models')
+    config.include('.cache')
+    config.include('.assets')
     config.include('.routes')
     config.include('.security')
-    config.scan()
+    config.include('.views')
     return config.make_wsgi_app()
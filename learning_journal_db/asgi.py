@@ -0,0 +1,223 @@
+"""
+An ASGI front end for the journal, served by ``runapp_async.py``.
+
+``make_asgi_app`` builds the same Pyramid app as ``main`` and runs each
+request on the event loop inside ``AsyncSession.run_sync``: views,
+templates and the security policy are unchanged, but ``request.dbsession``
+is the synchronous face of an ``AsyncSession``, so while a request waits
+for the database the loop serves other requests instead of a thread
+sitting idle. Idle keep-alive connections cost no thread at all.
+
+Routes that block on something other than the database run in a thread
+pool, as they would under waitress: ``login`` waits for the password hash
+process pool and ``export`` streams from a session of its own.
+
+Settings:
+
+- ``sqlalchemy.async_url``: the database url with an asyncio driver
+  (default: ``sqlalchemy.url`` with asyncpg for PostgreSQL, aiosqlite for
+  SQLite). Pool options are shared with the primary engine; read replicas
+  are not used.
+- ``asgi.thread_routes``: routes run in the thread pool (default
+  ``login export``)
+- ``asgi.threads``: size of the thread pool (default 10)
+
+This needs the ``async`` extra (``pip install -e .[async]``).
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.request import Request
+from pyramid.settings import aslist
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_engine_from_config
+
+from . import main
+from .metrics import instrument_engine
+from .models import engine_options
+from .models.routing import RoutingSession
+
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+DEFAULT_THREAD_ROUTES = 'login export'
+
+
+def async_url(settings):
+    """Return the url of the async engine, see the module docstring."""
+    if settings.get('sqlalchemy.async_url'):
+        return settings['sqlalchemy.async_url']
+    url = make_url(settings['sqlalchemy.url'])
+    backend = url.drivername.split('+')[0]
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError('No asyncio driver known for %r; set '
+                         'sqlalchemy.async_url' % url.drivername)
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def get_async_engine(settings):
+    options = engine_options(settings)
+    options['url'] = async_url(settings)
+    engine = async_engine_from_config(options, prefix='')
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+def wsgi_environ(scope, body):
+    """Return the WSGI environ of an ASGI HTTP request (PEP 3333)."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # The body has been read in full, chunked or not.
+    if body and 'CONTENT_LENGTH' not in environ:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def call_wsgi(app, environ):
+    """Call a WSGI app; return its status, headers and app_iter."""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    app_iter = app(environ, start_response)
+    return started[0], started[1], app_iter
+
+
+class AsgiApp(object):
+    """Serve a Pyramid WSGI app over ASGI; see the module docstring."""
+
+    def __init__(self, wsgi_app, engine, thread_routes=(), threads=10):
+        self.wsgi_app = wsgi_app
+        self.engine = engine
+        self.thread_routes = set(thread_routes)
+        self.executor = ThreadPoolExecutor(threads)
+        self.routes_mapper = wsgi_app.registry.getUtility(IRoutesMapper)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            body = await self._read_body(receive)
+            environ = wsgi_environ(scope, body)
+            if self._in_thread(environ):
+                await self._call_in_thread(environ, send)
+            else:
+                await self._call_on_loop(environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _in_thread(self, environ):
+        route = self.routes_mapper(Request(environ))['route']
+        return route is not None and route.name in self.thread_routes
+
+    async def _call_on_loop(self, environ, send):
+        def handle(session):
+            environ['learning_journal_db.dbsession'] = session
+            status, headers, app_iter = call_wsgi(self.wsgi_app, environ)
+            try:
+                return status, headers, b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+        async with AsyncSession(self.engine,
+                                sync_session_class=RoutingSession) as session:
+            status, headers, body = await session.run_sync(handle)
+        await self._start(send, status, headers)
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _call_in_thread(self, environ, send):
+        loop = asyncio.get_running_loop()
+        status, headers, app_iter = await loop.run_in_executor(
+            self.executor, call_wsgi, self.wsgi_app, environ)
+        try:
+            await self._start(send, status, headers)
+            chunks = iter(app_iter)
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await loop.run_in_executor(self.executor, app_iter.close)
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def _start(self, send, status, headers):
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+
+
+def make_asgi_app(global_config, **settings):
+    """Return the journal as an ASGI application."""
+    wsgi_app = main(global_config, **settings)
+    settings = wsgi_app.registry.settings
+    return AsgiApp(
+        wsgi_app, get_async_engine(settings),
+        thread_routes=aslist(settings.get('asgi.thread_routes',
+                                          DEFAULT_THREAD_ROUTES)),
+        threads=int(settings.get('asgi.threads', 10)))
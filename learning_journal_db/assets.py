@@ -0,0 +1,63 @@
+"""
+Serving the static assets.
+
+Activate it with ``config.include('learning_journal_db.assets')``.
+
+``build_assets`` copies every file of ``static/`` into ``static/build/``
+under a name containing a hash of its content, with gzip and brotli
+variants of the text files, and lists the names in
+``static/build/manifest.json``. When the manifest exists,
+``request.static_url`` returns the hashed names (a Pyramid cache buster),
+which are served with a one-year immutable Cache-Control: a page viewed
+again makes no asset requests at all. Each file is sent in the smallest
+encoding the client accepts.
+
+Without a build, as in development, assets keep their names and may be
+cached for an hour. With ``pyramid.reload_assets = true`` the manifest is
+read again whenever it changes.
+"""
+import os
+
+from pyramid.events import NewResponse
+from pyramid.settings import asbool
+from pyramid.static import ManifestCacheBuster
+
+
+STATIC_SPEC = 'learning_journal_db:static/'
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+
+# Built files live under this subdirectory of static/.
+BUILD_DIR = 'build'
+MANIFEST = os.path.join(STATIC_DIR, BUILD_DIR, 'manifest.json')
+
+CACHE_MAX_AGE = 3600
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Variants looked for next to each file, best first.
+CONTENT_ENCODINGS = ('br', 'gzip')
+
+
+def cache_built_assets(event):
+    """Let clients keep hashed assets for a year without revalidating."""
+    request = event.request
+    route = request.matched_route
+    if route is None or route.name != '__static/':
+        return
+    response = event.response
+    if request.subpath[:1] == (BUILD_DIR,) and response.status_int in (
+            200, 304):
+        response.cache_expires(IMMUTABLE_MAX_AGE)
+        response.cache_control.public = True
+        response.headers['Cache-Control'] += ', immutable'
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.add_static_view('static', STATIC_SPEC,
+                           cache_max_age=CACHE_MAX_AGE,
+                           content_encodings=CONTENT_ENCODINGS)
+    reload = asbool(settings.get('pyramid.reload_assets', False))
+    if reload or os.path.exists(MANIFEST):
+        config.add_cache_buster(STATIC_SPEC,
+                                ManifestCacheBuster(MANIFEST, reload=reload))
+    config.add_subscriber(cache_built_assets, NewResponse)
@@ -0,0 +1,110 @@
+"""
+In-process cache of rendered entry pages.
+
+Activate it with ``config.include('learning_journal_db.cache')``; the size
+limits come from the ``render_cache.max_entries`` and
+``render_cache.max_bytes`` settings (set either to 0 to disable it).
+"""
+import collections
+import threading
+
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class RenderCache(object):
+    """
+    A thread-safe LRU of rendered pages keyed by entry id and version.
+
+    Only the newest version of an entry is kept; a lookup for any other
+    version is a miss. The cache holds at most ``max_entries`` pages and
+    ``max_bytes`` bytes of page bodies, evicting the least recently used
+    pages first.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entry_id, version):
+        """Return the cached page body for this version, or None."""
+        with self._lock:
+            cached = self._pages.get(entry_id)
+            if cached is None or cached[0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pages.pop(entry_id)
+            self._pages[entry_id] = cached
+            return cached[1]
+
+    def put(self, entry_id, version, body):
+        """Store the rendered ``body`` (bytes) of an entry version."""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(entry_id)
+            self._pages[entry_id] = (version, body)
+            self.size_bytes += len(body)
+            while (len(self._pages) > self.max_entries or
+                   self.size_bytes > self.max_bytes):
+                evicted_id = next(iter(self._pages))
+                self._discard(evicted_id)
+                self.evictions += 1
+
+    def invalidate(self, entry_id):
+        """Drop any cached page of the entry."""
+        with self._lock:
+            self._discard(entry_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._pages),
+                'bytes': self.size_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _discard(self, entry_id):
+        cached = self._pages.pop(entry_id, None)
+        if cached is not None:
+            self.size_bytes -= len(cached[1])
+
+
+def invalidate_after_commit(request, entry_id):
+    """
+    Drop the cached page of ``entry_id`` once the request's transaction
+    commits. Nothing happens if it aborts, so a failed write can't evict
+    (or replace) the page of the version that is still current.
+    """
+    cache = request.registry.get('render_cache')
+    if cache is None:
+        return
+
+    def hook(committed):
+        if committed:
+            cache.invalidate(entry_id)
+
+    request.tm.get().addAfterCommitHook(hook)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    max_entries = int(settings.get('render_cache.max_entries',
+                                   DEFAULT_MAX_ENTRIES))
+    max_bytes = int(settings.get('render_cache.max_bytes',
+                                 DEFAULT_MAX_BYTES))
+    if max_entries > 0 and max_bytes > 0:
+        config.registry['render_cache'] = RenderCache(max_entries, max_bytes)
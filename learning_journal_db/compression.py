@@ -0,0 +1,133 @@
+"""
+Compressing responses with brotli or gzip.
+
+Activate it with ``config.include('learning_journal_db.compression')``.
+A tween picks the best encoding the client accepts and compresses the
+response body as it is sent, one chunk of the ``app_iter`` at a time, so
+streamed responses such as the export stay streamed and are never held
+in memory. Responses are left alone when they are small, already encoded
+(pre-compressed static files), of a type that doesn't compress (images,
+zip files, fonts) or marked ``no-transform``.
+
+Settings:
+
+- ``compression.enabled`` (default true; turn it off behind a proxy
+  that compresses)
+- ``compression.gzip_level``: 1-9 (default 6)
+- ``compression.brotli_quality``: 0-11 (default 5)
+- ``compression.min_size``: bodies of known length shorter than this many
+  bytes are sent as they are (default 1024)
+"""
+import zlib
+
+import brotli
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+
+
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+DEFAULT_MIN_SIZE = 1024
+
+# Best first; the client's q-values decide between them.
+ENCODINGS = ('br', 'gzip')
+
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def compressible(response, min_size):
+    """Return True if ``response`` is worth compressing."""
+    if response.status_int < 200 or response.status_int in (204, 206, 304):
+        return False
+    if response.content_encoding or response.cache_control.no_transform:
+        return False
+    content_type = response.content_type or ''
+    if not (content_type.startswith('text/') or
+            content_type in COMPRESSIBLE_TYPES or
+            content_type.endswith(('+json', '+xml'))):
+        return False
+    length = response.content_length
+    return length is None or length >= min_size
+
+
+def gzip_iter(app_iter, level):
+    """Yield ``app_iter`` compressed with gzip."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def brotli_iter(app_iter, quality):
+    """Yield ``app_iter`` compressed with brotli."""
+    compressor = brotli.Compressor(quality=quality)
+    try:
+        for chunk in app_iter:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def compression_tween_factory(handler, registry):
+    settings = registry.settings
+    gzip_level = int(settings.get('compression.gzip_level',
+                                  DEFAULT_GZIP_LEVEL))
+    brotli_quality = int(settings.get('compression.brotli_quality',
+                                      DEFAULT_BROTLI_QUALITY))
+    min_size = int(settings.get('compression.min_size', DEFAULT_MIN_SIZE))
+
+    def compression_tween(request):
+        response = handler(request)
+        if request.method == 'HEAD' or not compressible(response, min_size):
+            return response
+        vary = tuple(response.vary or ())
+        if 'Accept-Encoding' not in vary:
+            response.vary = vary + ('Accept-Encoding',)
+        # Without the header any encoding is allowed, but clients that
+        # send none generally can't decode any.
+        if 'Accept-Encoding' not in request.headers:
+            return response
+        offers = request.accept_encoding.acceptable_offers(ENCODINGS)
+        if not offers:
+            return response
+        encoding = offers[0][0]
+        if encoding == 'br':
+            app_iter = brotli_iter(response.app_iter, brotli_quality)
+        else:
+            app_iter = gzip_iter(response.app_iter, gzip_level)
+        response.app_iter = app_iter
+        response.content_length = None
+        response.content_encoding = encoding
+        # The compressed body is a different representation.
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
+
+    return compression_tween
+
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('compression.enabled', True)):
+        return
+    # Above the exception view tween, so error pages are compressed too.
+    config.add_tween(
+        'learning_journal_db.compression.compression_tween_factory',
+        under=INGRESS)
@@ -0,0 +1,214 @@
+"""
+Reading and writing journal entries as JSON Lines or CSV records.
+
+Everything here streams: entries are read from the database in keyset
+batches and records are read from files one at a time, so memory use
+doesn't depend on the size of the journal.
+"""
+import csv
+import datetime
+import io
+import json
+import sys
+import zipfile
+
+from .markup import rendered_values
+from .models import MyModel
+
+
+FORMATS = ('jsonl', 'csv')
+
+FIELDS = ['id', 'title', 'body', 'created_at', 'updated_at']
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def guess_format(path):
+    """Return the record format implied by the extension of ``path``."""
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def format_timestamp(value):
+    return value.strftime(TIMESTAMP_FORMAT) if value is not None else None
+
+
+def parse_timestamp(value):
+    """Parse a timestamp written by ``format_timestamp`` (or without µs)."""
+    if not value:
+        return None
+    for fmt in (TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized timestamp %r' % value)
+
+
+def entry_to_record(entry):
+    """Return the export record of an entry (or a row with its columns)."""
+    return {
+        'id': entry.id,
+        'title': entry.title,
+        'body': entry.body,
+        'created_at': format_timestamp(entry.created_at),
+        'updated_at': format_timestamp(entry.updated_at),
+    }
+
+
+def record_to_values(record, owner_id, now=None):
+    """
+    Return the column values of a new entry of the user ``owner_id`` built
+    from an import record.
+
+    Record ids are ignored; imported entries always get new ids.
+    """
+    now = now or datetime.datetime.utcnow()
+    created_at = parse_timestamp(record.get('created_at')) or now
+    updated_at = parse_timestamp(record.get('updated_at')) or created_at
+    values = {
+        'title': record.get('title') or u'',
+        'body': record.get('body') or u'',
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'version': 1,
+        'owner_id': owner_id,
+    }
+    values.update(rendered_values(values['body']))
+    return values
+
+
+def iter_entries(dbsession, batch_size=1000, owner_id=None):
+    """
+    Yield every entry in id order, fetching ``batch_size`` rows at a time;
+    only those of the user ``owner_id`` if it is given.
+
+    Each batch is a separate keyset query ("id > last id seen"), and the
+    session's transaction is ended once a batch is read, so its
+    connection goes back to the pool while the caller works through the
+    rows. Entries written meanwhile may or may not be included, but none
+    is yielded twice; earlier batches can be garbage collected.
+    """
+    columns = [getattr(MyModel, name) for name in FIELDS]
+    query = dbsession.query(*columns)
+    if owner_id is not None:
+        query = query.filter(MyModel.owner_id == owner_id)
+    last_id = 0
+    while True:
+        rows = query.filter(MyModel.id > last_id).order_by(
+            MyModel.id).limit(batch_size).all()
+        # Only reads: give the connection back before using the rows.
+        dbsession.rollback()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_id = rows[-1].id
+
+
+def iter_jsonl(session_factory, batch_size=1000, chunk_size=64 * 1024,
+               owner_id=None):
+    """
+    Yield the whole journal, or the entries of the user ``owner_id``, as
+    UTF-8 JSON Lines in chunks of about ``chunk_size`` bytes.
+
+    The generator opens its own session and closes it when it is
+    exhausted or closed, so it can outlive the request's transaction and
+    be used as a WSGI ``app_iter``. A connection is only checked out while
+    a batch is read, never while a chunk waits for the client, so slow
+    downloads can't use up the pool.
+    """
+    dbsession = session_factory()
+    try:
+        chunk, size = [], 0
+        for row in iter_entries(dbsession, batch_size, owner_id):
+            line = json.dumps(entry_to_record(row), ensure_ascii=False)
+            line = (line + u'\n').encode('utf-8')
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b''.join(chunk)
+    finally:
+        dbsession.close()
+
+
+class _ZipStream(object):
+    """A write-only file that hands what is written to it back out."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def iter_zip(chunks, member_name):
+    """
+    Yield a zip archive with a single deflated member whose content is
+    the concatenation of ``chunks``, without holding either in memory.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(member_name, 'w', force_zip64=True) as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = stream.drain()
+                if data:
+                    yield data
+    yield stream.drain()
+
+
+def read_records(stream, fmt):
+    """Yield import records (dicts) from a text stream."""
+    if fmt == 'csv':
+        csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+        for record in csv.DictReader(stream):
+            yield record
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RecordWriter(object):
+    """Serialize export records one at a time into a text stream."""
+
+    def __init__(self, stream, fmt):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(stream, FIELDS)
+            self._csv.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self._csv.writerow(record)
+        else:
+            self.stream.write(json.dumps(record, ensure_ascii=False))
+            self.stream.write(u'\n')
+
+
+def open_text(path, mode):
+    """Open ``path`` for text I/O as UTF-8; '-' means stdin/stdout."""
+    if path == '-':
+        return io.open((sys.stdin if 'r' in mode else sys.stdout).fileno(),
+                       mode, encoding='utf-8', newline='', closefd=False)
+    return io.open(path, mode, encoding='utf-8', newline='')
@@ -0,0 +1,92 @@
+"""
+Rendering entry bodies, written in Markdown, to HTML.
+
+Bodies are rendered once, when an entry is saved, and the sanitized HTML
+is stored next to the source in ``MyModel.body_html``; pages only output
+the stored HTML. The excerpt, word count and reading time shown on the
+list page are worked out from the same HTML and stored in narrow columns,
+so listing entries never loads a body.
+
+``body_html_version`` records the ``RENDERER_VERSION`` these columns were
+made with: bump the version whenever ``rendered_values`` would give
+different values (a new extension, different allowed tags, a longer
+excerpt) and run ``render_bodies <config_uri>`` to update the stale rows.
+"""
+import math
+from html import unescape
+
+import markdown
+import nh3
+
+
+# Bump when rendered_values() would give different values for the same text.
+RENDERER_VERSION = 2
+
+# Excerpts are at most this many characters, plus an ellipsis.
+EXCERPT_LENGTH = 200
+
+WORDS_PER_MINUTE = 200
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables', 'sane_lists']
+
+ALLOWED_TAGS = set([
+    'a', 'abbr', 'blockquote', 'br', 'code', 'del', 'em', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'hr', 'img', 'li', 'ol', 'p', 'pre', 'strong',
+    'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+])
+
+ALLOWED_ATTRIBUTES = {
+    'a': set(['href', 'title']),
+    'abbr': set(['title']),
+    'img': set(['src', 'alt', 'title']),
+    'td': set(['align']),
+    'th': set(['align']),
+}
+
+URL_SCHEMES = set(['http', 'https', 'mailto'])
+
+
+def render_body(text):
+    """Return ``text`` rendered from Markdown to sanitized HTML."""
+    html = markdown.markdown(text or u'', extensions=MARKDOWN_EXTENSIONS,
+                             output_format='html')
+    return nh3.clean(html, tags=ALLOWED_TAGS,
+                     attributes=ALLOWED_ATTRIBUTES, url_schemes=URL_SCHEMES,
+                     link_rel='nofollow noopener')
+
+
+def plain_text(html):
+    """Return the text of ``html`` with tags removed and spaces collapsed."""
+    return u' '.join(unescape(nh3.clean(html, tags=set())).split())
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    """
+    Return the start of ``text``: whole sentences if one ends in the
+    second half of the first ``length`` characters, whole words otherwise.
+    """
+    if len(text) <= length:
+        return text
+    cut = text[:length]
+    end = max(cut.rfind(mark) for mark in (u'. ', u'! ', u'? '))
+    if end >= length // 2:
+        return cut[:end + 1]
+    return cut.rsplit(u' ', 1)[0] + u'\u2026'
+
+
+def rendered_values(text):
+    """
+    Return the columns derived from the body of an entry whose body is
+    ``text``: its HTML, excerpt, word count and reading time.
+    """
+    html = render_body(text)
+    words = plain_text(html)
+    word_count = len(words.split())
+    minutes = int(math.ceil(word_count / float(WORDS_PER_MINUTE)))
+    return {
+        'body_html': html,
+        'body_html_version': RENDERER_VERSION,
+        'excerpt': make_excerpt(words),
+        'word_count': word_count,
+        'reading_minutes': minutes,
+    }
@@ -0,0 +1,254 @@
+"""
+Per-request timing and SQL instrumentation.
+
+Activate it with ``config.include('learning_journal_db.metrics')``. Each
+request is timed by a tween that sits outside ``pyramid_tm``, so its total
+includes the commit; within it, a view deriver times the view and its
+renderer, a ``BeforeRender`` subscriber marks where rendering starts, and
+engine events from ``models.get_engine`` time every SQL statement. The
+numbers are aggregated into per-route histograms and served in the
+Prometheus text format by the ``metrics`` view.
+
+Settings:
+
+- ``metrics.enabled`` (default true)
+- ``metrics.slow_request_ms``: requests slower than this are logged with
+  their breakdown (default 1000, 0 disables the log)
+"""
+import contextvars
+import logging
+import threading
+import time
+
+from pyramid.events import BeforeRender
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+from sqlalchemy import event
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# A context variable rather than a thread local, so that requests sharing
+# a thread under the ASGI front end each see their own stats.
+_current = contextvars.ContextVar('journal_request_stats', default=None)
+
+
+class RequestStats(object):
+    """What one request spent its time on, in seconds."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.sql_queries = 0
+        self.sql_time = 0.0
+        self.view_time = 0.0
+        self.render_start = None
+        self.render_time = 0.0
+
+
+class Histogram(object):
+    """A cumulative histogram in the Prometheus sense, one per label set."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self):
+        """Yield (le, cumulative count) pairs, ending with +Inf."""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield repr(float(bound)), cumulative
+        yield '+Inf', self.count
+
+
+class Metrics(object):
+    """Thread-safe per-route histograms and counters."""
+
+    HISTOGRAMS = [
+        ('journal_request_duration_seconds',
+         'Total time spent on a request, including the commit.'),
+        ('journal_view_duration_seconds',
+         'Time spent in the view and its renderer.'),
+        ('journal_render_duration_seconds',
+         'Time spent rendering templates.'),
+        ('journal_sql_duration_seconds',
+         'Time spent executing SQL statements per request.'),
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict((name, {}) for name, _ in self.HISTOGRAMS)
+        self.requests = {}
+        self.sql_queries = {}
+        self.slow_requests = {}
+
+    def record(self, route, stats, total, slow):
+        observed = {
+            'journal_request_duration_seconds': total,
+            'journal_view_duration_seconds': stats.view_time,
+            'journal_render_duration_seconds': stats.render_time,
+            'journal_sql_duration_seconds': stats.sql_time,
+        }
+        with self._lock:
+            for name, value in observed.items():
+                histograms = self._histograms[name]
+                if route not in histograms:
+                    histograms[route] = Histogram()
+                histograms[route].observe(value)
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.sql_queries[route] = (self.sql_queries.get(route, 0) +
+                                       stats.sql_queries)
+            if slow:
+                self.slow_requests[route] = (
+                    self.slow_requests.get(route, 0) + 1)
+
+    def render(self, extra=()):
+        """
+        Return every metric in the Prometheus text exposition format.
+
+        ``extra`` is an iterable of (name, type, help, value) tuples for
+        process-wide values such as cache counters.
+        """
+        lines = []
+        with self._lock:
+            for name, help_text in self.HISTOGRAMS:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for route, histogram in sorted(self._histograms[name].items()):
+                    for le, count in histogram.samples():
+                        lines.append('%s_bucket{route="%s",le="%s"} %d' % (
+                            name, route, le, count))
+                    lines.append('%s_sum{route="%s"} %r' % (
+                        name, route, histogram.total))
+                    lines.append('%s_count{route="%s"} %d' % (
+                        name, route, histogram.count))
+            counters = [
+                ('journal_requests_total', 'Requests handled.',
+                 self.requests),
+                ('journal_sql_queries_total', 'SQL statements executed.',
+                 self.sql_queries),
+                ('journal_slow_requests_total',
+                 'Requests slower than metrics.slow_request_ms.',
+                 self.slow_requests),
+            ]
+            for name, help_text, values in counters:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s counter' % name)
+                for route, value in sorted(values.items()):
+                    lines.append('%s{route="%s"} %d' % (name, route, value))
+        for name, metric_type, help_text, value in extra:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def current_stats():
+    """Return the RequestStats of the request being handled, if any."""
+    return _current.get()
+
+
+def instrument_engine(engine):
+    """Count and time the statements ``engine`` runs for each request."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if current_stats() is not None:
+            conn.info.setdefault('query_start', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        stats = current_stats()
+        starts = conn.info.get('query_start')
+        if stats is None or not starts:
+            return
+        stats.sql_queries += 1
+        stats.sql_time += time.time() - starts.pop()
+
+
+def metrics_tween_factory(handler, registry):
+    metrics = registry['metrics']
+    slow_threshold = float(registry.settings.get(
+        'metrics.slow_request_ms', 1000)) / 1000.0
+
+    def metrics_tween(request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            return handler(request)
+        finally:
+            _current.reset(token)
+            total = time.time() - stats.start
+            route = _route_name(request)
+            slow = 0 < slow_threshold < total
+            metrics.record(route, stats, total, slow)
+            if slow:
+                log.warning(
+                    'Slow request %s %s (%s): %.0f ms total, %.0f ms view, '
+                    '%.0f ms render, %d queries in %.0f ms',
+                    request.method, request.path_qs, route, total * 1000,
+                    stats.view_time * 1000, stats.render_time * 1000,
+                    stats.sql_queries, stats.sql_time * 1000)
+
+    return metrics_tween
+
+
+def _route_name(request):
+    route = getattr(request, 'matched_route', None)
+    if route is None:
+        return 'notfound'
+    return route.name
+
+
+def timed_view(view, info):
+    """View deriver timing the view callable together with its renderer."""
+
+    def wrapper(context, request):
+        stats = current_stats()
+        if stats is None:
+            return view(context, request)
+        start = time.time()
+        try:
+            return view(context, request)
+        finally:
+            end = time.time()
+            stats.view_time += end - start
+            if stats.render_start is not None:
+                stats.render_time += end - stats.render_start
+                stats.render_start = None
+
+    return wrapper
+
+
+def mark_render_start(event):
+    stats = current_stats()
+    if stats is not None and stats.render_start is None:
+        stats.render_start = time.time()
+
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('metrics.enabled', True)):
+        return
+    config.registry['metrics'] = Metrics()
+    config.add_tween('learning_journal_db.metrics.metrics_tween_factory',
+                     under=INGRESS)
+    config.add_view_deriver(timed_view)
+    config.add_subscriber(mark_render_start, BeforeRender)
@@ -1,24 +1,121 @@
+import os
+import weakref
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.settings import asbool, aslist
+from pyramid_tm import is_tm_active
 from sqlalchemy import engine_from_config
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import configure_mappers
 import zope.sqlalchemy
 
+from ..metrics import instrument_engine
+from .routing import ReplicaSet, RoutingSession
+
 # import or define all models here to ensure they are attached to the
 # Base.metadata prior to any initialization routines
 from .mymodel import MyModel  # noqa
+from .revision import EntryRevision  # noqa
+from .tag import EntryTag, Tag, TagCount  # noqa
+from .user import User  # noqa
+from .archive import ArchiveMonth  # noqa
+from . import search  # noqa
 
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
 configure_mappers()
 
 
+# Requests with these methods only read, so they run without a transaction.
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+# Every engine made by get_engine(), so that forked processes can be given
+# pools of their own.
+_engines = weakref.WeakSet()
+
+
+def _dispose_pools_after_fork():
+    # The child must not use the parent's pooled connections; dispose()
+    # with close=False forgets them without closing them under the parent.
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_pools_after_fork)
+
+# engine_from_config leaves these as strings, and 'false' is truthy.
+BOOLEAN_ENGINE_OPTIONS = ('pool_pre_ping', 'pool_use_lifo')
+
+
+def _engine_options(settings, prefix):
+    options = {}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            options[key[len(prefix):]] = value
+    for key in BOOLEAN_ENGINE_OPTIONS:
+        if key in options:
+            options[key] = asbool(options[key])
+    return options
+
+
+def engine_options(settings, prefix='sqlalchemy.'):
+    """
+    Return the ``<prefix>*`` settings of the primary engine, unprefixed.
+
+    The ``<prefix>replica.*`` settings and ``<prefix>async_url`` belong to
+    get_replica_engines() and the ASGI front end.
+    """
+    options = _engine_options(settings, prefix)
+    for key in list(options):
+        if key.startswith('replica.') or key == 'async_url':
+            del options[key]
+    return options
+
+
 def get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    """
+    Create the engine configured by the ``<prefix>*`` settings.
+
+    Besides the url, pool options such as ``pool_size``, ``max_overflow``,
+    ``pool_recycle`` and ``pool_pre_ping`` are passed to the engine. A
+    process forked later starts with an empty pool.
+    """
+    engine = engine_from_config(engine_options(settings, prefix), prefix='')
+    instrument_engine(engine)
+    _engines.add(engine)
+    return engine
 
 
-def get_session_factory(engine):
-    factory = sessionmaker()
-    factory.configure(bind=engine)
+def get_replica_engines(settings, prefix='sqlalchemy.'):
+    """
+    Create an engine for every url in ``<prefix>replica.url``.
+
+    Replicas share the primary's pool options, which can be overridden
+    with ``<prefix>replica.<option>`` settings.
+    """
+    urls = aslist(settings.get(prefix + 'replica.url', ''))
+    if not urls:
+        return []
+    options = engine_options(settings, prefix)
+    options.update(_engine_options(settings, prefix + 'replica.'))
+    for key in ('retry_interval', 'stickiness'):
+        options.pop(key, None)
+    engines = []
+    for url in urls:
+        options['url'] = url
+        engines.append(get_engine(options, prefix=''))
+    return engines
+
+
+def get_session_factory(engine, replicas=None):
+    """
+    Return a session factory bound to ``engine``.
+
+    ``replicas`` is an optional ReplicaSet; sessions created with
+    ``info={'read_only': True}`` read from it.
+    """
+    factory = sessionmaker(class_=RoutingSession)
+    factory.configure(bind=engine, info={'replicas': replicas})
     return factory
 
 
@@ -49,6 +146,38 @@ def get_tm_session(session_factory, transaction_manager):
     return dbsession
 
 
+def skip_transaction(config, *route_names):
+    """
+    Config directive marking routes whose views never write to the
+    database.
+
+    Requests to these routes are not wrapped in a transaction, whatever
+    their method; they get a read-only session like GET requests.
+
+    """
+    config.registry.setdefault('no_transaction_routes', set()).update(
+        route_names)
+
+
+def transaction_needed(request):
+    """
+    The ``tm.activate_hook``: whether pyramid_tm should manage ``request``.
+
+    GET and HEAD requests get a read-only session outside the transaction
+    manager instead, and routes marked with ``config.skip_transaction``
+    need no session at all. The hook runs before routing, so the route is
+    matched here.
+
+    """
+    if request.method in READ_ONLY_METHODS:
+        return False
+    skipped = request.registry.get('no_transaction_routes')
+    if not skipped:
+        return True
+    route = request.registry.getUtility(IRoutesMapper)(request)['route']
+    return route is None or route.name not in skipped
+
+
 def includeme(config):
     """
     Initialize the model for a Pyramid app.
@@ -58,16 +187,50 @@ def includeme(config):
     """
     settings = config.get_settings()
 
-    # use pyramid_tm to hook the transaction lifecycle to the request
+    # use pyramid_tm to hook the transaction lifecycle to the request,
+    # leaving out the requests that don't write
+    settings.setdefault('tm.activate_hook', transaction_needed)
+    # one manager per request rather than per thread, as requests served
+    # by the ASGI front end share the event loop's thread
+    settings.setdefault('tm.manager_hook', 'pyramid_tm.explicit_manager')
     config.include('pyramid_tm')
-
-    session_factory = get_session_factory(get_engine(settings))
+    config.add_directive('skip_transaction', skip_transaction)
+
+    replicas = None
+    replica_engines = get_replica_engines(settings)
+    if replica_engines:
+        replicas = ReplicaSet(replica_engines, int(settings.get(
+            'sqlalchemy.replica.retry_interval', 30)))
+    session_factory = get_session_factory(get_engine(settings), replicas)
     config.registry['dbsession_factory'] = session_factory
+    stickiness = int(settings.get('sqlalchemy.replica.stickiness', 5))
+
+    def dbsession(request):
+        # The ASGI front end (see ..asgi) passes in a session of its own.
+        dbsession = request.environ.get('learning_journal_db.dbsession')
+        if dbsession is None:
+            dbsession = session_factory()
+        if is_tm_active(request):
+            # r.tm is the transaction manager used by pyramid_tm
+            zope.sqlalchemy.register(
+                dbsession, transaction_manager=request.tm)
+        else:
+            # Nothing to commit: skip the data manager and two-phase
+            # commit, and just close the session once the request is done.
+            dbsession.info['read_only'] = True
+            request.add_finished_callback(lambda request: dbsession.close())
+        if replicas is None:
+            return dbsession
+        if request.method in READ_ONLY_METHODS:
+            # Right after a write, keep reading from the primary so that
+            # users see their own changes despite replication lag.
+            if 'read_primary' in request.cookies:
+                dbsession.info['replica'] = None
+        elif stickiness > 0:
+            request.add_response_callback(
+                lambda request, response: response.set_cookie(
+                    'read_primary', '1', max_age=stickiness, httponly=True))
+        return dbsession
 
     # make request.dbsession available for use in Pyramid
-    config.add_request_method(
-        # r.tm is the transaction manager used by pyramid_tm
-        lambda r: get_tm_session(session_factory, r.tm),
-        'dbsession',
-        reify=True
-    )
+    config.add_request_method(dbsession, 'dbsession', reify=True)
@@ -0,0 +1,97 @@
+"""
+The monthly archive: how many entries each user wrote in each month.
+
+``ArchiveMonth`` holds one row per user and month and is kept up to date
+as entries are created, in the same transaction, so the archive sidebar
+reads a handful of rows instead of grouping the whole ``models`` table.
+An entry never moves to another month (its ``created_at`` doesn't
+change), so editing one leaves the archive alone.
+
+``rebuild_archive`` recounts everything from the entries, for databases
+that have entries from before the archive (``migrate_db`` runs it) or
+that were written to around it.
+"""
+import collections
+
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Integer,
+    extract,
+    func,
+    select,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .meta import Base
+from .mymodel import MyModel
+
+
+class ArchiveMonth(Base):
+    __tablename__ = 'archive_months'
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                      primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    entries = Column(Integer, nullable=False, default=0)
+
+
+# Dialects whose INSERT can add to the count of an existing row.
+UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def add_to_archive(dbsession, owner_id, created_ats):
+    """
+    Count new entries of the user ``owner_id``, created at the datetimes
+    ``created_ats``, in their months.
+    """
+    counts = collections.Counter((d.year, d.month) for d in created_ats)
+    table = ArchiveMonth.__table__
+    insert = UPSERT_INSERTS.get(dbsession.get_bind().dialect.name)
+    # Always in the same order, so concurrent writers can't deadlock.
+    for (year, month), count in sorted(counts.items()):
+        key = {'owner_id': owner_id, 'year': year, 'month': month}
+        if insert is not None:
+            statement = insert(table).values(entries=count, **key)
+            dbsession.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.owner_id, table.c.year,
+                                table.c.month],
+                set_={'entries': table.c.entries + statement.excluded.entries}
+            ))
+            continue
+        updated = dbsession.execute(table.update().where(
+            table.c.owner_id == owner_id, table.c.year == year,
+            table.c.month == month).values(
+            entries=table.c.entries + count))
+        if not updated.rowcount:
+            dbsession.execute(table.insert().values(entries=count, **key))
+
+
+def archive_months(dbsession, owner_id):
+    """Return (year, month, entry count) of the user's months, newest first."""
+    return dbsession.query(
+        ArchiveMonth.year, ArchiveMonth.month, ArchiveMonth.entries
+    ).filter(
+        ArchiveMonth.owner_id == owner_id, ArchiveMonth.entries > 0
+    ).order_by(ArchiveMonth.year.desc(), ArchiveMonth.month.desc()).all()
+
+
+def rebuild_archive(connection):
+    """
+    Recount the archive of every user from the entries, replacing what it
+    held. Return the number of months.
+    """
+    table = ArchiveMonth.__table__
+    entries = MyModel.__table__
+    year = extract('year', entries.c.created_at)
+    month = extract('month', entries.c.created_at)
+    connection.execute(table.delete())
+    connection.execute(table.insert().from_select(
+        ['owner_id', 'year', 'month', 'entries'],
+        select(entries.c.owner_id, year, month, func.count()).group_by(
+            entries.c.owner_id, year, month)))
+    return connection.execute(
+        select(func.count()).select_from(table)).scalar()
@@ -1,19 +1,63 @@
+import datetime
+
 from sqlalchemy import (
     Column,
+    DateTime,
+    ForeignKey,
     Index,
     Integer,
+    Unicode,
     UnicodeText,
 )
 
+from ..markup import EXCERPT_LENGTH, rendered_values
 from .meta import Base
 
 
 class MyModel(Base):
     __tablename__ = 'models'
     id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                      nullable=False)
     title = Column(UnicodeText)
+    # Legacy RFC 2822 timestamp string, superseded by created_at.
     date = Column(UnicodeText)
+    # Markdown source, and the sanitized HTML pages show (see ..markup).
     body = Column(UnicodeText)
+    body_html = Column(UnicodeText)
+    body_html_version = Column(Integer)
+    # Shown on the list page, which never loads the body.
+    excerpt = Column(Unicode(EXCERPT_LENGTH + 1))
+    word_count = Column(Integer)
+    reading_minutes = Column(Integer)
+    # When render_bodies last rewrote the columns above; it leaves
+    # updated_at alone, so list validators watch both.
+    rendered_at = Column(DateTime)
+    created_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow)
+    # Bumped on every edit; previous versions live in EntryRevision.
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    def set_body(self, body):
+        """Set the Markdown body and the columns derived from it."""
+        self.body = body
+        for name, value in rendered_values(body).items():
+            setattr(self, name, value)
 
 
 Index('my_index', MyModel.id, unique=True, mysql_length=255)
+Index('ix_models_created_at', MyModel.created_at, MyModel.id)
+Index('ix_models_updated_at', MyModel.updated_at)
+# Each user's list pages and validators are ranges of these; the
+# validators read one max from each of the last three.
+Index('ix_models_owner_id_created_at', MyModel.owner_id, MyModel.created_at,
+      MyModel.id)
+Index('ix_models_owner_id_id', MyModel.owner_id, MyModel.id)
+Index('ix_models_owner_id_updated_at', MyModel.owner_id, MyModel.updated_at)
+Index('ix_models_owner_id_rendered_at', MyModel.owner_id,
+      MyModel.rendered_at)
@@ -0,0 +1,52 @@
+import zlib
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    UnicodeText,
+)
+
+from .meta import Base
+
+
+class EntryRevision(Base):
+    """
+    A superseded version of a journal entry.
+
+    Bodies are stored zlib-compressed so that keeping every version around
+    stays cheap; the live text is always on the ``MyModel`` row.
+    """
+    __tablename__ = 'entry_revisions'
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(Integer, ForeignKey('models.id', ondelete='CASCADE'),
+                      nullable=False)
+    version = Column(Integer, nullable=False)
+    title = Column(UnicodeText)
+    body_zlib = Column(LargeBinary)
+    # When this version was written, i.e. the entry's updated_at back then.
+    saved_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Snapshot the current state of ``entry``."""
+        return cls(
+            entry_id=entry.id,
+            version=entry.version,
+            title=entry.title,
+            body_zlib=zlib.compress((entry.body or u'').encode('utf-8')),
+            saved_at=entry.updated_at,
+        )
+
+    @property
+    def body(self):
+        if self.body_zlib is None:
+            return u''
+        return zlib.decompress(self.body_zlib).decode('utf-8')
+
+
+Index('ix_entry_revisions_entry_id', EntryRevision.entry_id,
+      EntryRevision.version, unique=True)
@@ -0,0 +1,101 @@
+"""
+Routing of read-only sessions to database replicas.
+
+Sessions created by ``get_session_factory`` are ``RoutingSession``
+instances. A session whose ``info['read_only']`` is true refuses to flush
+and runs its queries on one of the replicas, picked round-robin when the
+session first needs a connection (setting ``info['replica']`` to None
+keeps it on the primary). Replicas that fail are taken out of the
+rotation for ``retry_interval`` seconds. With no healthy replica, reads
+fall back to the primary.
+"""
+import itertools
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import Session
+
+
+log = logging.getLogger(__name__)
+
+
+class ReplicaSet(object):
+    """Round-robin choice among replica engines with failure tracking."""
+
+    def __init__(self, engines, retry_interval=30):
+        self.engines = list(engines)
+        self.retry_interval = retry_interval
+        self._cycle = itertools.cycle(self.engines)
+        self._down_until = {}
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def choose(self):
+        """
+        Return a replica engine that accepts connections, or None.
+
+        Checking a connection out of the replica's pool first means a
+        replica that has gone away costs a failed connect here, not a
+        failed request.
+        """
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = next(self._cycle)
+                down_until = self._down_until.get(engine)
+            if down_until is not None and down_until > time.time():
+                continue
+            if self._probe(engine):
+                return engine
+        return None
+
+    def mark_down(self, engine):
+        now = time.time()
+        with self._lock:
+            was_up = self._down_until.get(engine, 0) <= now
+            self._down_until[engine] = now + self.retry_interval
+        if was_up:
+            log.warning('Replica %r is unavailable; retrying in %s seconds',
+                        engine.url, self.retry_interval)
+
+    def _probe(self, engine):
+        try:
+            engine.connect().close()
+        except Exception:
+            self.mark_down(engine)
+            return False
+        with self._lock:
+            was_down = self._down_until.pop(engine, None) is not None
+        if was_down:
+            log.info('Replica %r is back', engine.url)
+        return True
+
+    def _handle_error(self, context):
+        # Failing to connect, or losing the connection, takes the replica
+        # out of the rotation; ordinary SQL errors don't.
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+
+class RoutingSession(Session):
+    """A session sending the reads of read-only sessions to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replicas = self.info.get('replicas')
+        if replicas is not None and self.info.get('read_only'):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.choose()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super(RoutingSession, self).get_bind(
+            mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _refuse_read_only_flush(session, flush_context, instances):
+    # Read-only sessions are never committed, so a flush would be lost.
+    if session.info.get('read_only'):
+        raise InvalidRequestError('Cannot flush a read-only session')
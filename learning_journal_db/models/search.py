@@ -0,0 +1,218 @@
+"""
+Full-text search over entry titles and bodies.
+
+The index lives in the database and is maintained by triggers on the
+``models`` table, so every insert or edit of an entry (from the views,
+scripts or anywhere else) updates it in the same transaction:
+
+- SQLite uses an FTS5 table with ``models`` as its external content.
+- PostgreSQL uses a weighted ``tsvector`` column with a GIN index.
+
+The DDL runs whenever ``models`` is created through ``metadata.create_all``;
+``create_search_index`` adds it to an existing database.
+"""
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    UnicodeText,
+    event,
+    text,
+)
+
+from .mymodel import MyModel
+
+
+# Snippets come back from the database with matches wrapped in these
+# control characters, which can't occur in form input, so the text can be
+# escaped safely before they are turned into <mark> tags.
+MATCH_START = u'\x02'
+MATCH_END = u'\x03'
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE models_fts USING fts5("
+    "title, body, content='models', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER models_fts_insert AFTER INSERT ON models BEGIN "
+    "INSERT INTO models_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER models_fts_delete AFTER DELETE ON models BEGIN "
+    "INSERT INTO models_fts(models_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER models_fts_update AFTER UPDATE OF title, body ON models "
+    "BEGIN "
+    "INSERT INTO models_fts(models_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO models_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); END",
+]
+
+SQLITE_REBUILD = "INSERT INTO models_fts(models_fts) VALUES ('rebuild')"
+
+SQLITE_DROP = ["DROP TABLE IF EXISTS models_fts"]
+
+SQLITE_SEARCH = """
+SELECT m.id, m.title, m.created_at,
+       snippet(models_fts, 1, :start, :end, '...', 24) AS snippet
+FROM models_fts JOIN models AS m ON m.id = models_fts.rowid
+WHERE models_fts MATCH :query AND m.owner_id = :owner_id
+ORDER BY bm25(models_fts, 10.0, 1.0), m.id DESC
+LIMIT :limit OFFSET :offset
+"""
+
+POSTGRES_DDL = [
+    "ALTER TABLE models ADD COLUMN search_vector tsvector",
+    "CREATE INDEX ix_models_search_vector ON models "
+    "USING gin(search_vector)",
+    "CREATE OR REPLACE FUNCTION models_search_vector_update() "
+    "RETURNS trigger AS $$ BEGIN "
+    "NEW.search_vector := "
+    "setweight(to_tsvector('pg_catalog.english', "
+    "coalesce(NEW.title, '')), 'A') || "
+    "setweight(to_tsvector('pg_catalog.english', "
+    "coalesce(NEW.body, '')), 'B'); "
+    "RETURN NEW; END $$ LANGUAGE plpgsql",
+    "CREATE TRIGGER models_search_vector_update "
+    "BEFORE INSERT OR UPDATE OF title, body ON models "
+    "FOR EACH ROW EXECUTE PROCEDURE models_search_vector_update()",
+]
+
+POSTGRES_REBUILD = (
+    "UPDATE models SET search_vector = "
+    "setweight(to_tsvector('pg_catalog.english', coalesce(title, '')), 'A')"
+    " || setweight(to_tsvector('pg_catalog.english', coalesce(body, '')),"
+    " 'B')"
+)
+
+POSTGRES_DROP = ["DROP FUNCTION IF EXISTS models_search_vector_update() "
+                 "CASCADE"]
+
+# The headline is computed in an outer query so that Postgres only builds
+# it for the rows on the page, not for every match.
+POSTGRES_SEARCH = """
+SELECT m.id, m.title, m.created_at,
+       ts_headline('pg_catalog.english', m.body, hits.query,
+                   'StartSel=' || :start || ', StopSel=' || :end ||
+                   ', MaxFragments=1, MaxWords=30, MinWords=10') AS snippet
+FROM (
+    SELECT models.id, query, ts_rank(search_vector, query) AS rank
+    FROM models, plainto_tsquery('pg_catalog.english', :query) AS query
+    WHERE search_vector @@ query AND models.owner_id = :owner_id
+    ORDER BY rank DESC, models.id DESC
+    LIMIT :limit OFFSET :offset
+) AS hits JOIN models AS m ON m.id = hits.id
+ORDER BY hits.rank DESC, m.id DESC
+"""
+
+
+class SearchResult(object):
+    """One ranked search hit; ``snippet`` is HTML-safe markup."""
+
+    def __init__(self, id, title, created_at, snippet):
+        self.id = id
+        self.title = title
+        self.created_at = created_at
+        self.snippet = snippet
+
+
+def search_entries(dbsession, owner_id, terms, limit, offset=0):
+    """
+    Return up to ``limit`` entries of the user ``owner_id`` matching
+    ``terms``, best match first.
+
+    Entry bodies never leave the database; each hit only carries a
+    highlighted snippet of its body.
+    """
+    dialect = dbsession.get_bind().dialect.name
+    if dialect == 'sqlite':
+        sql, query = SQLITE_SEARCH, fts5_query(terms)
+    else:
+        sql, query = POSTGRES_SEARCH, terms
+    if not query:
+        return []
+    statement = text(sql).columns(
+        id=Integer, title=UnicodeText, created_at=DateTime,
+        snippet=UnicodeText)
+    rows = dbsession.execute(statement, {
+        'query': query,
+        'owner_id': owner_id,
+        'start': MATCH_START,
+        'end': MATCH_END,
+        'limit': limit,
+        'offset': offset,
+    }).fetchall()
+    return [SearchResult(row.id, row.title, row.created_at,
+                         highlight(row.snippet))
+            for row in rows]
+
+
+def fts5_query(terms):
+    """
+    Turn free text into an FTS5 query matching all of its words.
+
+    Each word is quoted so that FTS5 operators and punctuation typed by
+    the user can't produce a syntax error.
+    """
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    return u' '.join(u'"%s"' % word for word in words)
+
+
+def highlight(snippet):
+    """Escape ``snippet`` and wrap the matched words in <mark> tags."""
+    if snippet is None:
+        return Markup(u'')
+    return Markup(escape(snippet).replace(
+        MATCH_START, Markup(u'<mark>')).replace(
+        MATCH_END, Markup(u'</mark>')))
+
+
+def _statements(connection, sqlite_statements, postgres_statements):
+    if connection.dialect.name == 'sqlite':
+        return sqlite_statements
+    if connection.dialect.name == 'postgresql':
+        return postgres_statements
+    return []
+
+
+def search_index_exists(connection):
+    """Return True if the search index has been created."""
+    if connection.dialect.name == 'sqlite':
+        return bool(connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'models_fts'"
+        )).fetchall())
+    if connection.dialect.name == 'postgresql':
+        return bool(connection.execute(text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'models' AND column_name = 'search_vector'"
+        )).fetchall())
+    return True
+
+
+def create_search_index(connection):
+    """Create the search index and its triggers if they don't exist yet."""
+    if search_index_exists(connection):
+        return
+    for statement in _statements(connection, SQLITE_DDL, POSTGRES_DDL):
+        connection.execute(text(statement))
+
+
+def rebuild_search_index(connection):
+    """Re-index every entry from the contents of the ``models`` table."""
+    statements = _statements(connection, [SQLITE_REBUILD], [POSTGRES_REBUILD])
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def _after_create(target, connection, **kw):
+    create_search_index(connection)
+
+
+def _before_drop(target, connection, **kw):
+    for statement in _statements(connection, SQLITE_DROP, POSTGRES_DROP):
+        connection.execute(text(statement))
+
+
+event.listen(MyModel.__table__, 'after_create', _after_create)
+event.listen(MyModel.__table__, 'before_drop', _before_drop)
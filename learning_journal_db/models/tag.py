@@ -0,0 +1,173 @@
+"""
+Tags on journal entries.
+
+Every user has tags of their own: a tag name is unique per owner.
+
+``EntryTag`` rows link entries to tags and carry a copy of the entry's
+``created_at``, so that the entries with a tag are read newest first
+straight from the ``(tag_id, created_at, entry_id)`` index, without
+sorting. How many entries each tag has is kept in ``TagCount`` and
+changed as entries are tagged and untagged, so the tag cloud never counts
+the link table.
+"""
+import re
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    Unicode,
+)
+from sqlalchemy.exc import IntegrityError
+
+from .archive import UPSERT_INSERTS
+from .meta import Base
+
+
+MAX_TAG_LENGTH = 64
+
+
+class Tag(Base):
+    __tablename__ = 'tags'
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                      nullable=False)
+    name = Column(Unicode(MAX_TAG_LENGTH), nullable=False)
+
+
+class EntryTag(Base):
+    __tablename__ = 'entry_tags'
+    entry_id = Column(Integer, ForeignKey('models.id', ondelete='CASCADE'),
+                      primary_key=True)
+    tag_id = Column(Integer, ForeignKey('tags.id', ondelete='CASCADE'),
+                    primary_key=True)
+    # The entry's created_at, which never changes.
+    created_at = Column(DateTime, nullable=False)
+
+
+class TagCount(Base):
+    __tablename__ = 'tag_counts'
+    tag_id = Column(Integer, ForeignKey('tags.id', ondelete='CASCADE'),
+                    primary_key=True)
+    entries = Column(Integer, nullable=False, default=0)
+
+
+Index('ix_tags_owner_id_name', Tag.owner_id, Tag.name, unique=True)
+Index('ix_entry_tags_tag_id', EntryTag.tag_id, EntryTag.created_at,
+      EntryTag.entry_id)
+Index('ix_tag_counts_entries', TagCount.entries)
+
+
+def parse_tags(text):
+    """
+    Return the tag names in ``text``, separated by commas: lower case,
+    with runs of spaces replaced by '-', without duplicates.
+    """
+    names = []
+    for name in re.split(u'[,\n]', text or u''):
+        name = u'-'.join(name.lower().split())[:MAX_TAG_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def entry_tag_names(dbsession, entry_id):
+    """Return the names of the tags of an entry, sorted."""
+    rows = dbsession.query(Tag.name).join(
+        EntryTag, EntryTag.tag_id == Tag.id).filter(
+        EntryTag.entry_id == entry_id).order_by(Tag.name)
+    return [name for (name,) in rows]
+
+
+def set_entry_tags(dbsession, entry, names):
+    """
+    Give ``entry``, which must have been flushed, exactly the tags
+    ``names``, updating the counts of the tags added and removed.
+    Return True if its tags changed.
+    """
+    current = dict(dbsession.query(Tag.name, Tag.id).join(
+        EntryTag, EntryTag.tag_id == Tag.id).filter(
+        EntryTag.entry_id == entry.id))
+    added = [name for name in names if name not in current]
+    removed = [tag_id for name, tag_id in current.items()
+               if name not in names]
+    if added:
+        tags = _get_or_create_tags(dbsession, entry.owner_id, added)
+        dbsession.add_all([
+            EntryTag(entry_id=entry.id, tag_id=tag.id,
+                     created_at=entry.created_at)
+            for tag in tags])
+        dbsession.flush()
+        _change_counts(dbsession, [tag.id for tag in tags], 1)
+    if removed:
+        dbsession.query(EntryTag).filter(
+            EntryTag.entry_id == entry.id,
+            EntryTag.tag_id.in_(removed)).delete(synchronize_session=False)
+        _change_counts(dbsession, removed, -1)
+    return bool(added or removed)
+
+
+def tag_cloud(dbsession, owner_id, limit=100):
+    """
+    Return (name, entry count) of the ``limit`` most used tags of the user
+    ``owner_id``.
+    """
+    return dbsession.query(Tag.name, TagCount.entries).join(
+        TagCount, TagCount.tag_id == Tag.id).filter(
+        Tag.owner_id == owner_id, TagCount.entries > 0).order_by(
+        TagCount.entries.desc(), Tag.name).limit(limit).all()
+
+
+def _get_or_create_tags(dbsession, owner_id, names):
+    """
+    Return the user's tags named ``names``, adding those that are missing.
+    A tag another request adds at the same time is used, not added twice.
+    """
+    query = dbsession.query(Tag).filter(Tag.owner_id == owner_id)
+    tags = query.filter(Tag.name.in_(names)).all()
+    known = set(tag.name for tag in tags)
+    # Always in the same order, so concurrent writers can't deadlock.
+    missing = sorted(name for name in names if name not in known)
+    if not missing:
+        return tags
+    tag_table = Tag.__table__
+    for name in missing:
+        _insert_if_missing(dbsession, tag_table,
+                           {'owner_id': owner_id, 'name': name},
+                           [tag_table.c.owner_id, tag_table.c.name])
+    new = query.filter(Tag.name.in_(missing)).all()
+    count_table = TagCount.__table__
+    for tag in sorted(new, key=lambda tag: tag.id):
+        _insert_if_missing(dbsession, count_table,
+                           {'tag_id': tag.id, 'entries': 0},
+                           [count_table.c.tag_id])
+    return tags + new
+
+
+def _insert_if_missing(dbsession, table, values, index_elements):
+    """
+    Insert the row ``values`` into ``table`` unless a row with the same
+    ``index_elements`` (a unique index) is already there.
+    """
+    insert = UPSERT_INSERTS.get(dbsession.get_bind().dialect.name)
+    if insert is not None:
+        statement = insert(table).values(**values)
+        dbsession.execute(statement.on_conflict_do_nothing(
+            index_elements=index_elements))
+        return
+    try:
+        with dbsession.begin_nested():
+            dbsession.execute(table.insert().values(**values))
+    except IntegrityError:
+        # Added by another transaction since it was looked for.
+        pass
+
+
+def _change_counts(dbsession, tag_ids, delta):
+    # An UPDATE relative to the stored value, so concurrent writers
+    # don't lose each other's changes.
+    dbsession.query(TagCount).filter(TagCount.tag_id.in_(tag_ids)).update(
+        {TagCount.entries: TagCount.entries + delta},
+        synchronize_session=False)
@@ -0,0 +1,35 @@
+"""
+The people who keep journals.
+
+Every entry and tag belongs to one user, its owner, and everything a
+user sees is filtered by ``owner_id``. Accounts are added with the
+``add_user`` command.
+"""
+import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    Unicode,
+)
+
+from .meta import Base
+
+
+MAX_USERNAME_LENGTH = 64
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    # The userid remembered in the auth ticket.
+    username = Column(Unicode(MAX_USERNAME_LENGTH), nullable=False)
+    # A passlib hash (see ..security).
+    password_hash = Column(Unicode(255), nullable=False)
+    created_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+
+Index('ix_users_username', User.username, unique=True)
@@ -0,0 +1,205 @@
+"""
+A pre-forking process manager serving the app with waitress.
+
+The parent process loads the app once, binds the listening socket and
+forks ``workers`` children. Each child accepts connections on the
+inherited socket with its own waitress thread pool, so the site uses as
+many cores as there are workers, and the loaded app is shared between
+them copy-on-write. Children start with empty SQLAlchemy connection pools
+(see ``models.get_engine``).
+
+The parent restarts workers that die, and handles these signals:
+
+- SIGHUP: load the app again (re-reading the configuration), then replace
+  the workers one at a time, so some are always accepting connections
+- SIGTERM, SIGINT: stop the workers gracefully and exit
+
+A worker told to stop closes its listening socket, lets the requests it
+has started finish (for at most ``graceful_timeout`` seconds) and exits.
+"""
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+from waitress import wasyncore
+from waitress.server import create_server
+
+
+log = logging.getLogger(__name__)
+
+# A worker dying sooner than this after it started is probably failing
+# on every start; wait this long before starting the next one.
+RESPAWN_DELAY = 1.0
+
+
+class Arbiter(object):
+    """The parent process; see the module docstring."""
+
+    def __init__(self, load_app, host, port, workers=2, graceful_timeout=30,
+                 backlog=1024, **server_options):
+        self.load_app = load_app
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.server_options = server_options
+        self.app = None
+        self.socket = None
+        self.workers = {}
+        self._signals = []
+
+    def run(self):
+        self.app = self.load_app()
+        self.socket = self._listen()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signal)
+        log.info('Serving on http://%s:%s with %d workers', self.host,
+                 self.port, self.worker_count)
+        while len(self.workers) < self.worker_count:
+            self.spawn()
+        while True:
+            self.reap()
+            if not self._signals:
+                time.sleep(0.5)
+                continue
+            signum = self._signals.pop(0)
+            if signum == signal.SIGHUP:
+                self.reload()
+            else:
+                self.stop()
+                return
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def spawn(self):
+        """Fork a worker; return its pid."""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+        status = 0
+        try:
+            serve_worker(self.app, self.socket, self.graceful_timeout,
+                         **self.server_options)
+        except BaseException:
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap(self):
+        """Collect workers that exited; start replacements for them."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            log.warning('Worker %d exited with status %d', pid, status)
+            if time.time() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            self.spawn()
+
+    def reload(self):
+        """Load the app again and replace the workers one at a time."""
+        try:
+            app = self.load_app()
+        except Exception:
+            log.exception('Reload failed; keeping the current workers')
+            return
+        self.app = app
+        log.info('Reloaded; replacing %d workers', len(self.workers))
+        for pid in list(self.workers):
+            self.spawn()
+            self.workers.pop(pid, None)
+            self._terminate(pid)
+
+    def stop(self):
+        log.info('Stopping %d workers', len(self.workers))
+        pids = list(self.workers)
+        self.workers.clear()
+        for pid in pids:
+            _kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        for pid in pids:
+            self._wait(pid, deadline)
+        self.socket.close()
+
+    def _terminate(self, pid):
+        _kill(pid, signal.SIGTERM)
+        self._wait(pid, time.time() + self.graceful_timeout)
+
+    def _wait(self, pid, deadline):
+        """Wait for worker ``pid`` to exit; kill it at ``deadline``."""
+        while True:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if done:
+                return
+            if time.time() >= deadline:
+                log.warning('Worker %d did not stop in time; killing it', pid)
+                _kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return
+            time.sleep(0.1)
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def serve_worker(app, sock, graceful_timeout=30, **server_options):
+    """
+    Serve ``app`` on the listening socket ``sock`` until SIGTERM, then
+    finish the requests in progress and return.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # Ctrl-C reaches the whole process group; the parent does the stopping.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+
+    server = create_server(app, sockets=[sock], **server_options)
+    while not stopping:
+        wasyncore.loop(timeout=1.0, map=server._map, count=1,
+                       use_poll=server.adj.asyncore_use_poll)
+
+    # Stop accepting, ask idle keep-alive connections to close, and keep
+    # the loop going until the requests in progress have been answered.
+    server.del_channel()
+    sock.close()
+    deadline = time.time() + graceful_timeout
+    while server.active_channels and time.time() < deadline:
+        for channel in list(server.active_channels.values()):
+            if not channel.requests:
+                channel.will_close = True
+        wasyncore.loop(timeout=0.1, map=server._map, count=1,
+                       use_poll=server.adj.asyncore_use_poll)
+    server.task_dispatcher.shutdown()
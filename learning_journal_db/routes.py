@@ -1,9 +1,21 @@
 def includeme(config):
-    config.add_static_view('static', 'learning_journal_db:static')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
     config.add_route('home', '/')
     config.add_route('lists', '/list')
+    config.add_route('search', '/search')
+    config.add_route('tags', '/tags')
+    config.add_route('tag', '/tag/{name}')
+    config.add_route('archive', '/archive/{year:\d{4}}/{month:\d{1,2}}')
+    config.add_route('export', '/export.{ext:(jsonl|zip)}')
     config.add_route('create', '/journal/new-entry')
     config.add_route('detail', '/journal/{id:\d+}')
     config.add_route('update', '/journal/{id:\d+}/edit-entry')
+    config.add_route('history', '/journal/{id:\d+}/history')
+    config.add_route('api_entries', '/api/entries')
+    config.add_route('render_cache_stats', '/admin/render-cache')
+    config.add_route('metrics', '/metrics')
+
+    # add_static_view() (in .assets) names its route '__' + the view name.
+    # The others only read users, to log in or to authenticate.
+    config.skip_transaction('__static/', 'login', 'logout', 'home')
@@ -0,0 +1,81 @@
+"""
+Add a user, who can then log in and keep a journal of their own, or set
+the password of an existing one.
+
+The password is read from the terminal, or from the first line of
+standard input with ``--password-stdin``.
+"""
+import argparse
+import getpass
+import os
+import sys
+import transaction
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+
+from ..models import (
+    get_engine,
+    get_session_factory,
+    get_tm_session,
+    )
+from ..models import User
+from ..models.user import MAX_USERNAME_LENGTH
+from ..security import hash_password
+
+
+def set_user(dbsession, username, password_hash):
+    """
+    Give the user ``username`` the password ``password_hash``, adding the
+    user if there is none. Return True if the user was added.
+    """
+    user = dbsession.query(User).filter(User.username == username).first()
+    if user is not None:
+        user.password_hash = password_hash
+        return False
+    dbsession.add(User(username=username, password_hash=password_hash))
+    return True
+
+
+def read_password(from_stdin):
+    if from_stdin:
+        return sys.stdin.readline().rstrip('\n')
+    password = getpass.getpass('Password: ')
+    if getpass.getpass('Repeat password: ') != password:
+        sys.exit('The passwords differ.')
+    return password
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Add a user or set their password.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('username')
+    parser.add_argument('vars', nargs='*', metavar='var=value',
+                        help='overrides for the config file')
+    parser.add_argument('--password-stdin', action='store_true',
+                        help='read the password from standard input')
+    args = parser.parse_args(argv[1:])
+    if not args.username or len(args.username) > MAX_USERNAME_LENGTH:
+        parser.error('usernames have 1 to %d characters'
+                     % MAX_USERNAME_LENGTH)
+    password = read_password(args.password_stdin)
+    if not password:
+        sys.exit('The password is empty.')
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri,
+                               options=parse_vars(args.vars))
+    session_factory = get_session_factory(get_engine(settings))
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory, transaction.manager)
+        added = set_user(dbsession, args.username, hash_password(password))
+    if added:
+        print('Added user %s.' % args.username)
+    else:
+        print('Set the password of %s.' % args.username)
@@ -0,0 +1,129 @@
+"""
+Build the static assets for production (see ``..assets``).
+
+Every file under ``static/``, apart from ``static/build/`` itself, is
+written to ``static/build/`` with the first characters of the SHA-256 of
+its content in its name, and text files also get ``.gz`` and ``.br``
+variants when those are smaller. ``url()`` references in CSS files are
+pointed at the hashed names first, so a stylesheet's hash changes with
+the fonts and images it uses. The manifest is replaced last and
+atomically; files of earlier builds are kept, since processes still
+running may link to them.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import sys
+
+import brotli
+
+from ..assets import BUILD_DIR, STATIC_DIR
+
+
+HASH_LENGTH = 12
+
+COMPRESSIBLE = ('.css', '.html', '.js', '.json', '.svg', '.txt', '.xml')
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def asset_paths(source_dir, build_dir):
+    """Return the '/' separated paths of the files to build, CSS last."""
+    paths = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.join(root, d) != build_dir)
+        for filename in files:
+            path = os.path.relpath(os.path.join(root, filename), source_dir)
+            paths.append(path.replace(os.sep, '/'))
+    return sorted(paths, key=lambda p: (p.endswith('.css'), p))
+
+
+def hashed_name(path, content):
+    """Return ``path`` with a hash of ``content`` before its extension."""
+    root, ext = posixpath.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def rewrite_css_urls(css, css_path, manifest, built_dir):
+    """
+    Point the relative ``url()`` references of the stylesheet ``css_path``
+    at the built names in ``manifest``; ``built_dir`` is the directory the
+    stylesheet is built into. References to other files are left alone.
+    """
+    directory = posixpath.dirname(css_path)
+
+    def replace(match):
+        url = match.group(2)
+        path = re.split('[?#]', url, 1)[0]
+        target = posixpath.normpath(posixpath.join(directory, path))
+        if target not in manifest or ':' in url or url.startswith('/'):
+            return match.group(0)
+        new = posixpath.relpath(manifest[target], built_dir)
+        return 'url(%s%s%s)' % (match.group(1), new + url[len(path):],
+                                match.group(1))
+
+    return CSS_URL.sub(replace, css)
+
+
+def write_file(path, content):
+    if os.path.exists(path):
+        return
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def compressed_variants(content):
+    """Yield (extension, bytes) of the variants smaller than ``content``."""
+    variants = [
+        ('.gz', gzip.compress(content, compresslevel=9, mtime=0)),
+        ('.br', brotli.compress(content, quality=11)),
+    ]
+    for ext, compressed in variants:
+        if len(compressed) < len(content):
+            yield ext, compressed
+
+
+def build_assets(source_dir=STATIC_DIR, build_dir=None):
+    """Build the assets of ``source_dir``; return the manifest written."""
+    build_dir = build_dir or os.path.join(source_dir, BUILD_DIR)
+    prefix = os.path.relpath(build_dir, source_dir).replace(os.sep, '/')
+    manifest = {}
+    for path in asset_paths(source_dir, build_dir):
+        with open(os.path.join(source_dir, path), 'rb') as f:
+            content = f.read()
+        built_dir = posixpath.join(prefix, posixpath.dirname(path))
+        if path.endswith('.css'):
+            content = rewrite_css_urls(content.decode('utf-8'), path,
+                                       manifest, built_dir).encode('utf-8')
+        name = posixpath.join(prefix, hashed_name(path, content))
+        target = os.path.join(source_dir, *name.split('/'))
+        write_file(target, content)
+        if path.endswith(COMPRESSIBLE):
+            for ext, compressed in compressed_variants(content):
+                write_file(target + ext, compressed)
+        manifest[path] = name
+
+    manifest_path = os.path.join(build_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Build hashed, precompressed static assets.')
+    parser.parse_args(argv[1:])
+    manifest = build_assets()
+    print('Built %d assets into %s' % (
+        len(manifest), os.path.join(STATIC_DIR, BUILD_DIR)))
@@ -0,0 +1,200 @@
+"""
+Bulk import and export of journal entries as JSON Lines or CSV.
+
+Both commands stream, so memory use stays flat however many entries are
+moved. Imports are written in chunks with SQLAlchemy's bulk insert API,
+one transaction per chunk, and can record a checkpoint after every chunk
+so that an interrupted import picks up where it stopped.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import transaction
+import zope.sqlalchemy
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+
+from ..models import (
+    get_engine,
+    get_session_factory,
+    get_tm_session,
+    )
+from ..models import MyModel, User
+from ..models.archive import add_to_archive
+from ..journal_io import (
+    FORMATS,
+    RecordWriter,
+    entry_to_record,
+    guess_format,
+    iter_entries,
+    open_text,
+    read_records,
+    record_to_values,
+    )
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Checkpoint(object):
+    """
+    The number of records of ``source`` already imported, kept in a file.
+
+    The file is replaced atomically after each committed chunk. If the
+    process dies between a commit and the checkpoint write, that one
+    chunk is imported again on resume.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('source') != self.source:
+            raise ValueError('Checkpoint %s belongs to %s, not %s' % (
+                self.path, state.get('source'), self.source))
+        return state['records']
+
+    def save(self, records):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': self.source, 'records': records}, f)
+        os.rename(tmp_path, self.path)
+
+
+def import_records(session_factory, records, owner_id,
+                   batch_size=DEFAULT_BATCH_SIZE, checkpoint=None):
+    """
+    Insert ``records`` (an iterable of dicts) as new entries of the user
+    ``owner_id``.
+
+    Return the total number of records imported, including those done by
+    earlier runs recorded in ``checkpoint``.
+    """
+    done = checkpoint.load() if checkpoint is not None else 0
+    if done:
+        log.info('Resuming after %d records', done)
+    records = itertools.islice(records, done, None)
+    while True:
+        chunk = [record_to_values(r, owner_id)
+                 for r in itertools.islice(records, batch_size)]
+        if not chunk:
+            break
+        with transaction.manager:
+            dbsession = get_tm_session(session_factory, transaction.manager)
+            dbsession.bulk_insert_mappings(MyModel, chunk)
+            add_to_archive(dbsession, owner_id,
+                           [values['created_at'] for values in chunk])
+            # Bulk inserts bypass the unit of work, so tell the data
+            # manager there is something to commit.
+            zope.sqlalchemy.mark_changed(dbsession)
+        done += len(chunk)
+        if checkpoint is not None:
+            checkpoint.save(done)
+        log.info('Imported %d records', done)
+    return done
+
+
+def export_entries(session_factory, writer, batch_size=DEFAULT_BATCH_SIZE,
+                   owner_id=None):
+    """
+    Write every entry, or those of the user ``owner_id``, to ``writer``;
+    return the number written.
+    """
+    dbsession = session_factory()
+    count = 0
+    try:
+        for row in iter_entries(dbsession, batch_size, owner_id):
+            writer.write(entry_to_record(row))
+            count += 1
+    finally:
+        dbsession.close()
+    return count
+
+
+def _parser(prog, description, path_help):
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('path', help=path_help)
+    parser.add_argument('vars', nargs='*', metavar='var=value',
+                        help='overrides for the config file')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='record format (default: from the extension)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    return parser
+
+
+def _owner_id(parser, session_factory, username):
+    """Return the id of the user ``username``, exiting if there is none."""
+    dbsession = session_factory()
+    try:
+        owner_id = dbsession.query(User.id).filter(
+            User.username == username).scalar()
+    finally:
+        dbsession.close()
+    if owner_id is None:
+        parser.error('no user %r (add one with add_user)' % username)
+    return owner_id
+
+
+def _session_factory(args):
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri,
+                               options=parse_vars(args.vars))
+    return get_session_factory(get_engine(settings))
+
+
+def import_main(argv=sys.argv):
+    parser = _parser(os.path.basename(argv[0]),
+                     'Import journal entries from a JSONL or CSV file.',
+                     "file to read ('-' for stdin)")
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='record progress in FILE and resume from it')
+    parser.add_argument('--user', required=True,
+                        help='username of the owner of the new entries')
+    args = parser.parse_args(argv[1:])
+    fmt = args.format or guess_format(args.path)
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint, os.path.abspath(args.path))
+
+    session_factory = _session_factory(args)
+    owner_id = _owner_id(parser, session_factory, args.user)
+    with open_text(args.path, 'r') as stream:
+        done = import_records(session_factory, read_records(stream, fmt),
+                              owner_id, args.batch_size, checkpoint)
+    print('Imported %d entries.' % done)
+
+
+def export_main(argv=sys.argv):
+    parser = _parser(os.path.basename(argv[0]),
+                     'Export journal entries to a JSONL or CSV file.',
+                     "file to write ('-' for stdout)")
+    parser.add_argument('--user',
+                        help='only export the entries of this user')
+    args = parser.parse_args(argv[1:])
+    fmt = args.format or guess_format(args.path)
+
+    session_factory = _session_factory(args)
+    owner_id = None
+    if args.user:
+        owner_id = _owner_id(parser, session_factory, args.user)
+    with open_text(args.path, 'w') as stream:
+        count = export_entries(session_factory, RecordWriter(stream, fmt),
+                               args.batch_size, owner_id)
+    if args.path != '-':
+        print('Exported %d entries.' % count)
@@ -0,0 +1,45 @@
+"""
+Compile every template into the Jinja2 bytecode cache.
+
+Run it when deploying, with the same configuration as the app, so that
+workers find every template already compiled (see ``..templating``).
+"""
+import os
+import sys
+
+from pyramid.paster import (
+    bootstrap,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+from pyramid.settings import asbool
+
+from ..templating import get_environment, load_templates
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    env = bootstrap(config_uri, options=options)
+    try:
+        settings = env['registry'].settings
+        if not asbool(settings.get('jinja2.bytecode_caching', False)):
+            print('jinja2.bytecode_caching is off in %s; there is no cache '
+                  'to fill.' % config_uri)
+            sys.exit(1)
+        count = load_templates(get_environment(env['registry']))
+    finally:
+        env['closer']()
+    print('Compiled %d templates into %s' % (
+        count, settings['jinja2.bytecode_caching_directory']))
@@ -0,0 +1,258 @@
+"""
+Bring an existing learning journal database up to date with the models.
+
+Missing tables are created outright; the steps in ``MIGRATIONS`` then add
+the columns and indexes that ``create_all`` can't add to existing tables
+and backfill them. Every step checks the live schema first, so running the
+script again is harmless.
+"""
+import datetime
+import email.utils
+import logging
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import bindparam, inspect, text
+
+from ..models.meta import Base
+from ..models import get_engine
+from ..models import ArchiveMonth, MyModel, Tag, User
+from ..models.archive import rebuild_archive
+from ..models.search import (
+    create_search_index,
+    rebuild_search_index,
+    search_index_exists,
+)
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Formats used for ``MyModel.date`` before it was replaced by created_at.
+LEGACY_DATE_FORMATS = ['%B %d, %Y']
+
+# The single account of the journal before there were users; it gets
+# the existing entries. AUTH_USERNAME and AUTH_PASSWORD (a passlib hash)
+# override it.
+LEGACY_USERNAME = 'tw'
+LEGACY_PASSWORD_HASH = (
+    '$6$rounds=696756$UWRWhhuKcNTbArn.$cGYtf5qzBAq0mKBTVcro9K051.oxV0gblPIe'
+    '5LK25GahlwQnnEHaXWWYwQ1lX.w1czy/Xe/zJlDc84lafp7mW0')
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def column_names(connection, table_name):
+    """Return the set of column names ``table_name`` has in the database."""
+    return set(c['name'] for c in inspect(connection).get_columns(table_name))
+
+
+def add_column(connection, column):
+    """Add ``column``, a model ``Column``, to its table, as nullable."""
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+        column.table.name, column.name, column_type)))
+
+
+def parse_legacy_date(value):
+    """
+    Parse a legacy ``MyModel.date`` string into a naive UTC datetime.
+
+    Return None if the value can't be parsed.
+    """
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is not None:
+        timestamp = email.utils.mktime_tz(parsed)
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(
+            seconds=timestamp)
+    for fmt in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def add_timestamps(connection):
+    """Add created_at/updated_at and backfill them from the date strings."""
+    table = MyModel.__table__
+    existing = column_names(connection, table.name)
+    for column in (table.c.created_at, table.c.updated_at):
+        if column.name not in existing:
+            add_column(connection, column)
+
+    now = datetime.datetime.utcnow()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            text('SELECT id, date FROM models WHERE id > :last_id '
+                 'AND created_at IS NULL ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': BATCH_SIZE}
+        ).fetchall()
+        if not rows:
+            break
+        params = []
+        for row_id, date in rows:
+            created_at = parse_legacy_date(date)
+            if created_at is None:
+                log.warning('Entry %s has an unparseable date %r; '
+                            'using the current time.', row_id, date)
+                created_at = now
+            params.append({'_id': row_id, '_created_at': created_at})
+        connection.execute(
+            table.update()
+            .where(table.c.id == bindparam('_id'))
+            .values(created_at=bindparam('_created_at'),
+                    updated_at=bindparam('_created_at')),
+            params
+        )
+        last_id = rows[-1][0]
+
+    for index in table.indexes:
+        if index.name in ('ix_models_created_at', 'ix_models_updated_at'):
+            index.create(connection, checkfirst=True)
+
+
+def add_versions(connection):
+    """Add the version counter used for in-place edits."""
+    table = MyModel.__table__
+    if table.c.version.name not in column_names(connection, table.name):
+        add_column(connection, table.c.version)
+    connection.execute(
+        table.update().where(table.c.version.is_(None)).values(version=1))
+
+
+def add_body_html(connection):
+    """
+    Add the rendered body columns. They are filled by ``render_bodies``,
+    which can use several processes; pages show the plain body until then.
+    """
+    table = MyModel.__table__
+    existing = column_names(connection, table.name)
+    for column in (table.c.body_html, table.c.body_html_version):
+        if column.name not in existing:
+            add_column(connection, column)
+
+
+def add_summaries(connection):
+    """
+    Add the excerpt, word count and reading time columns, also filled by
+    ``render_bodies``, and the time it filled them (indexed by add_owners).
+    """
+    table = MyModel.__table__
+    existing = column_names(connection, table.name)
+    for column in (table.c.excerpt, table.c.word_count,
+                   table.c.reading_minutes, table.c.rendered_at):
+        if column.name not in existing:
+            add_column(connection, column)
+
+
+def legacy_owner_id(connection):
+    """Return the id of the legacy user, adding the user if missing."""
+    users = User.__table__
+    username = os.environ.get('AUTH_USERNAME') or LEGACY_USERNAME
+    select = users.select().with_only_columns(users.c.id).where(
+        users.c.username == username)
+    owner_id = connection.execute(select).scalar()
+    if owner_id is None:
+        connection.execute(users.insert().values(
+            username=username,
+            password_hash=(os.environ.get('AUTH_PASSWORD') or
+                           LEGACY_PASSWORD_HASH),
+            created_at=datetime.datetime.utcnow()))
+        owner_id = connection.execute(select).scalar()
+    return owner_id
+
+
+def add_owners(connection):
+    """
+    Add owner_id to entries and tags, and give the existing ones to the
+    legacy user; tag names become unique per owner.
+    """
+    tables = (MyModel.__table__, Tag.__table__)
+    owner_id = None
+    for table in tables:
+        if table.c.owner_id.name not in column_names(connection, table.name):
+            add_column(connection, table.c.owner_id)
+        unowned = connection.execute(
+            table.select().with_only_columns(table.c.id).where(
+                table.c.owner_id.is_(None)).limit(1)).first()
+        if unowned is not None:
+            if owner_id is None:
+                owner_id = legacy_owner_id(connection)
+            connection.execute(table.update().where(
+                table.c.owner_id.is_(None)).values(
+                owner_id=owner_id, **_unchanged(table)))
+
+    connection.execute(text('DROP INDEX IF EXISTS ix_tags_name'))
+    for table in tables:
+        for index in table.indexes:
+            if 'owner_id' in index.columns:
+                index.create(connection, checkfirst=True)
+
+
+def _unchanged(table):
+    # Keep onupdate timestamps as they are.
+    if 'updated_at' in table.c:
+        return {'updated_at': table.c.updated_at}
+    return {}
+
+
+def add_archive(connection):
+    """Count the existing entries into the monthly archive."""
+    archive = ArchiveMonth.__table__
+    if connection.execute(archive.select().limit(1)).first() is None:
+        rebuild_archive(connection)
+
+
+def add_search_index(connection):
+    """Create the full-text search index and fill it from existing rows."""
+    if not search_index_exists(connection):
+        create_search_index(connection)
+        rebuild_search_index(connection)
+
+
+MIGRATIONS = [
+    add_timestamps,
+    add_versions,
+    add_search_index,
+    add_body_html,
+    add_summaries,
+    add_owners,
+    add_archive,
+]
+
+
+def migrate(engine):
+    """Create missing tables and run every migration step in order."""
+    Base.metadata.create_all(engine)
+    for step in MIGRATIONS:
+        log.info('Running migration step %s', step.__name__)
+        with engine.begin() as connection:
+            step(connection)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+
+    engine = get_engine(settings)
+    migrate(engine)
@@ -0,0 +1,39 @@
+"""
+Recount the monthly archive of every user from their entries.
+
+The archive is kept up to date as entries are created (see
+``..models.archive``); run this after filling the database some other way,
+or to check it. It is one ``INSERT ... SELECT ... GROUP BY`` in a single
+transaction, so pages never see a half-built archive.
+"""
+import argparse
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+
+from ..models import get_engine
+from ..models.archive import rebuild_archive
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Recount the monthly archive from the entries.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('vars', nargs='*', metavar='var=value',
+                        help='overrides for the config file')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri,
+                               options=parse_vars(args.vars))
+    engine = get_engine(settings)
+    with engine.begin() as connection:
+        months = rebuild_archive(connection)
+    print('Rebuilt the archive: %d months.' % months)
@@ -0,0 +1,140 @@
+"""
+Render entry bodies again after ``RENDERER_VERSION`` changes.
+
+This fills in the HTML, excerpt, word count and reading time of existing
+entries (see ``..markup``). Rows whose ``body_html_version`` isn't the
+current version (or every row, with ``--all``) are read in keyset
+batches, rendered by a pool of worker processes and written back one
+transaction per batch. Only the derived columns change: entries keep
+their version and edit time (``rendered_at`` records the run instead),
+and the script can be stopped and run again at any point. A row is only
+written if its body is still the one that was rendered, so an entry
+edited meanwhile keeps its new HTML.
+"""
+import argparse
+import collections
+import datetime
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import bindparam, or_
+
+from ..markup import RENDERER_VERSION, rendered_values
+from ..models import get_engine
+from ..models import MyModel
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def stale_batches(engine, batch_size=DEFAULT_BATCH_SIZE, everything=False):
+    """Yield lists of (id, body) of the entries to render, in id order."""
+    table = MyModel.__table__
+    query = table.select().with_only_columns(table.c.id, table.c.body)
+    if not everything:
+        query = query.where(or_(
+            table.c.body_html_version.is_(None),
+            table.c.body_html_version != RENDERER_VERSION))
+    last_id = 0
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                query.where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        last_id = rows[-1][0]
+
+
+def render_batch(rows):
+    """
+    Return the derived column values of each (id, body) in ``rows``,
+    with the id and body they were rendered from.
+    """
+    batch = []
+    for row_id, body in rows:
+        values = dict(('_' + name, value)
+                      for name, value in rendered_values(body).items())
+        values.update(_id=row_id, _body=body)
+        batch.append(values)
+    return batch
+
+
+def write_batch(engine, rendered):
+    """
+    Write the values of ``render_batch`` to the rows whose body hasn't
+    changed since it was read.
+    """
+    table = MyModel.__table__
+    names = [name[1:] for name in rendered[0]
+             if name not in ('_id', '_body')]
+    with engine.begin() as connection:
+        values = dict((name, bindparam('_' + name)) for name in names)
+        # Not an edit: keep updated_at from its onupdate.
+        values['updated_at'] = table.c.updated_at
+        values['rendered_at'] = datetime.datetime.utcnow()
+        # An edit since the body was read has rendered it already.
+        connection.execute(
+            table.update().where(
+                table.c.id == bindparam('_id'),
+                table.c.body.is_not_distinct_from(bindparam('_body')))
+            .values(**values),
+            rendered)
+
+
+def rerender_bodies(engine, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                    everything=False):
+    """Render the stale entries again; return how many were rendered."""
+    workers = workers or os.cpu_count() or 1
+    done = 0
+    with ProcessPoolExecutor(workers) as pool:
+        # Keep every worker busy without reading the whole table ahead.
+        pending = collections.deque()
+        for batch in stale_batches(engine, batch_size, everything):
+            pending.append(pool.submit(render_batch, batch))
+            if len(pending) < workers * 2:
+                continue
+            rendered = pending.popleft().result()
+            write_batch(engine, rendered)
+            done += len(rendered)
+            log.info('Rendered %d entries', done)
+        while pending:
+            rendered = pending.popleft().result()
+            write_batch(engine, rendered)
+            done += len(rendered)
+    return done
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Render entry bodies made by an older renderer again.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('vars', nargs='*', metavar='var=value',
+                        help='overrides for the config file')
+    parser.add_argument('--all', dest='everything', action='store_true',
+                        help='render every entry, not only stale ones')
+    parser.add_argument('--workers', type=int,
+                        help='rendering processes (default: one per CPU)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri,
+                               options=parse_vars(args.vars))
+    engine = get_engine(settings)
+    done = rerender_bodies(engine, args.workers, args.batch_size,
+                           args.everything)
+    print('Rendered %d entries with renderer version %d.' % (
+        done, RENDERER_VERSION))
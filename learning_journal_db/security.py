@@ -1,4 +1,10 @@
+import collections
+import functools
+import hashlib
+import hmac
 import os
+import threading
+import time
 
 
 
@@ -7,23 +13,277 @@ from pyramid.exceptions import ConfigurationExecutionError
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.security import Everyone, Authenticated
 from pyramid.security import Allow
+from pyramid.settings import asbool, aslist
 
+from .models import User
 
-def check_credentials(username, password):
+
+# What requests know of the logged in user; cached across requests.
+CachedUser = collections.namedtuple('CachedUser', ['id', 'username'])
+
+
+def check_credentials(dbsession, username, password, verifier=None):
+    """
+    Return True if ``username`` and ``password`` match a stored user.
+
+    The password hash is checked by ``verifier`` (a ``PasswordVerifier``)
+    when one is given, and in the calling thread otherwise. A username
+    with no stored hash is checked against a dummy hash, so it takes as
+    long to turn away as a wrong password: response times don't tell
+    which usernames exist.
+    """
+    stored_password = dbsession.query(User.password_hash).filter(
+        User.username == username).scalar()
+    exists = bool(stored_password)
+    if not exists:
+        stored_password = _dummy_hash()
+    if verifier is None:
+        is_valid = verify_password(password, stored_password)
+    else:
+        is_valid = verifier.verify(username, password, stored_password)
+    return exists and is_valid
+
+
+@functools.lru_cache(maxsize=None)
+def _dummy_hash():
+    """Return a hash, made once per process, that no password matches."""
+    return hash_password(os.urandom(16).hex())
+
+
+def hash_password(password):
+    """Return the passlib hash stored for ``password``."""
+    from passlib.apps import custom_app_context
+    return custom_app_context.hash(password)
+
+
+def verify_password(password, stored_hash):
+    """Check ``password`` against a passlib hash in the calling thread."""
     from passlib.apps import custom_app_context
-    # stored_username = os.environ.get('AUTH_USERNAME', '')
-    # stored_password = os.environ.get('AUTH_PASSWORD', '')
-    stored_username = 'tw'
-    stored_password = '$6$rounds=696756$UWRWhhuKcNTbArn.$cGYtf5qzBAq0mKBTVcro9K051.oxV0gblPIe5LK25GahlwQnnEHaXWWYwQ1lX.w1czy/Xe/zJlDc84lafp7mW0'
-    is_authenticated = False
-    if stored_username and stored_password:
-        if username == stored_username:
-            try:
-                is_authenticated = custom_app_context.verify(password, stored_password)
-            except ValueError:
-                pass
-    return is_authenticated
+    try:
+        return custom_app_context.verify(password, stored_hash)
+    except ValueError:
+        return False
+
+
+class PasswordVerifier(object):
+    """
+    Verify passwords away from the request threads.
+
+    The sha512_crypt hashes are deliberately slow and hold the GIL while
+    they run, so with ``workers`` > 0 they are checked in a process pool
+    of that size; the request thread just waits on the result. The pool
+    is started on first use, so forked server workers each get their own.
+
+    With ``cache_ttl`` > 0, successful verifications are remembered for
+    that many seconds. Entries are keyed by an HMAC of the username,
+    password and stored hash under a per-process random key, so no
+    password is kept in memory and a changed hash invalidates the entry.
+    """
+
+    def __init__(self, workers=0, cache_ttl=0, cache_size=1024):
+        self.workers = workers
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._pool = None
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._cache_key = os.urandom(32)
+
+    def verify(self, username, password, stored_hash):
+        key = self._digest(username, password, stored_hash)
+        if self._cached(key):
+            return True
+        if self.workers > 0:
+            is_valid = self._get_pool().submit(
+                verify_password, password, stored_hash).result()
+        else:
+            is_valid = verify_password(password, stored_hash)
+        if is_valid:
+            self._remember(key)
+        return is_valid
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _digest(self, username, password, stored_hash):
+        message = u'\0'.join([username, password, stored_hash])
+        return hmac.new(self._cache_key, message.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def _cached(self, key):
+        if self.cache_ttl <= 0:
+            return False
+        with self._lock:
+            expires = self._cache.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._cache[key]
+                return False
+            return True
+
+    def _remember(self, key):
+        if self.cache_ttl <= 0:
+            return
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = time.time() + self.cache_ttl
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+class LoginThrottle(object):
+    """
+    Sliding-window limit on login attempts per key.
 
+    ``attempt(key)`` records an attempt and returns False once ``key`` has
+    made more than ``max_attempts`` attempts in the last ``window``
+    seconds. It is checked before any password hashing happens, so a
+    flood of logins is turned away cheaply.
+    """
+
+    def __init__(self, max_attempts, window, max_keys=10000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def attempt(self, key):
+        now = time.time()
+        with self._lock:
+            if len(self._attempts) >= self.max_keys:
+                self._sweep(now)
+            attempts = self._attempts.setdefault(key, collections.deque())
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.max_attempts:
+                return False
+            attempts.append(now)
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _sweep(self, now):
+        cutoff = now - self.window
+        for key in [k for k, v in self._attempts.items()
+                    if not v or v[-1] <= cutoff]:
+            del self._attempts[key]
+        if len(self._attempts) >= self.max_keys:
+            self._attempts.clear()
+
+
+def login_allowed(request, username):
+    """
+    Record a login attempt for ``username`` from the request's address.
+
+    Return False if the address has been making too many attempts, for
+    this username or any. Attempts on a username are counted per address,
+    so nobody can lock its user out by failing to log in as them.
+    """
+    registry = request.registry
+    user_throttle = registry.get('login_throttle_user')
+    ip_throttle = registry.get('login_throttle_ip')
+    if user_throttle is not None and not user_throttle.attempt(
+            (username, request.client_addr)):
+        return False
+    if ip_throttle is not None and not ip_throttle.attempt(
+            request.client_addr):
+        return False
+    return True
+
+
+def reset_login_attempts(request, username):
+    """
+    Forget the recorded attempts of ``username`` from the request's
+    address after a good login.
+    """
+    user_throttle = request.registry.get('login_throttle_user')
+    if user_throttle is not None:
+        user_throttle.reset((username, request.client_addr))
+
+
+
+class UserCache(object):
+    """
+    Per-process LRU cache of users by username, kept ``ttl`` seconds.
+
+    The authentication policy needs the user of every authenticated
+    request; with the cache, a user's requests only look the row up once
+    a ``ttl``. Users that don't exist aren't cached, so a new account can
+    log in at once, while a deleted one keeps working in each process
+    until its entry expires.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """Return the cached ``CachedUser`` for ``username``, or None."""
+        with self._lock:
+            cached = self._users.get(username)
+            if cached is None:
+                return None
+            user, expires = cached
+            if expires < time.time():
+                del self._users[username]
+                return None
+            self._users.move_to_end(username)
+            return user
+
+    def put(self, user):
+        with self._lock:
+            self._users.pop(user.username, None)
+            self._users[user.username] = (user, time.time() + self.ttl)
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._users.pop(username, None)
+
+
+def get_user(request):
+    """
+    Return the logged in user as a ``CachedUser``, or None; this is
+    ``request.user``.
+    """
+    username = request.unauthenticated_userid
+    if username is None:
+        return None
+    cache = request.registry.get('user_cache')
+    user = cache.get(username) if cache is not None else None
+    if user is None:
+        row = request.dbsession.query(User.id, User.username).filter(
+            User.username == username).first()
+        if row is None:
+            return None
+        user = CachedUser(row.id, row.username)
+        if cache is not None:
+            cache.put(user)
+    return user
+
+
+def groupfinder(userid, request):
+    """
+    Return the principals of ``userid``, or None if there is no such user:
+    admins get 'role:admin'.
+    """
+    if request.user is None:
+        return None
+    admins = aslist(request.registry.settings.get('auth.admin_users', ''))
+    if userid in admins:
+        return ['role:admin']
+    return []
 
 
 class MyRoot(object):
@@ -32,7 +292,8 @@ class MyRoot(object):
 
     __acl__ = [
         (Allow, Everyone, 'view'),
-        (Allow, Authenticated, 'secret')
+        (Allow, Authenticated, 'secret'),
+        (Allow, 'role:admin', 'admin'),
     ]
 
 
@@ -41,10 +302,30 @@ def includeme(config):
     auth_secret = os.environ.get('AUTH_SECRET', '')
     authn_policy = AuthTktAuthenticationPolicy(
             secret=auth_secret,
-            hashalg='sha512'
+            hashalg='sha512',
+            callback=groupfinder
     )
     config.set_authentication_policy(authn_policy)
     authz_policy = ACLAuthorizationPolicy()
     config.set_authorization_policy(authz_policy)
     # config.set_default_permission('view')
-    config.set_root_factory(MyRoot)
\ No newline at end of file
+    config.set_root_factory(MyRoot)
+
+    settings = config.get_settings()
+    config.add_request_method(get_user, 'user', reify=True)
+    user_cache_ttl = float(settings.get('auth.user_cache_ttl', 300))
+    if user_cache_ttl > 0:
+        config.registry['user_cache'] = UserCache(
+            user_cache_ttl,
+            int(settings.get('auth.user_cache_size', 10000)))
+    config.registry['password_verifier'] = PasswordVerifier(
+        workers=int(settings.get('auth.hash_workers', 0)),
+        cache_ttl=float(settings.get('auth.cache_ttl', 0)),
+    )
+    if asbool(settings.get('auth.throttle', True)):
+        window = float(settings.get('auth.throttle.window', 60))
+        config.registry['login_throttle_user'] = LoginThrottle(
+            int(settings.get('auth.throttle.max_attempts', 5)), window)
+        config.registry['login_throttle_ip'] = LoginThrottle(
+            int(settings.get('auth.throttle.max_attempts_per_ip', 20)),
+            window)
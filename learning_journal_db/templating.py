@@ -0,0 +1,84 @@
+"""
+Precompiling the Jinja2 templates.
+
+Activate it with ``config.include('learning_journal_db.templating')``.
+Compiled templates are kept by pyramid_jinja2's bytecode cache, set up
+with these settings:
+
+- ``jinja2.bytecode_caching = true``
+- ``jinja2.bytecode_caching_directory``: shared by every worker; created
+  when missing
+
+``compile_templates <config_uri>`` fills the cache at deploy time, and
+with ``templates.preload = true`` (default false) each process loads
+every template when the app is created, from the cache when possible,
+so no template is compiled or even read on a live request.
+
+Templates are loaded under the names rendering uses: asset specs such as
+``learning_journal_db:templates/login.jinja2`` for the pages, and the
+parent-relative names Jinja2 gives the templates they extend.
+"""
+import os
+
+from jinja2 import meta
+from pyramid.events import ApplicationCreated
+from pyramid.settings import asbool
+from pyramid_jinja2 import IJinja2Environment
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+TEMPLATE_SPEC = 'learning_journal_db:templates/%s'
+
+
+def template_names(directory=TEMPLATE_DIR):
+    """Return the asset spec of every .jinja2 template, sorted."""
+    names = []
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith('.jinja2'):
+                path = os.path.relpath(os.path.join(root, filename),
+                                       directory)
+                names.append(TEMPLATE_SPEC % path.replace(os.sep, '/'))
+    return sorted(names)
+
+
+def load_templates(environment, names=None):
+    """
+    Load ``names`` (default: every template) and the templates they extend,
+    include or import into ``environment``; return how many were loaded.
+    """
+    loaded = set()
+
+    def load(name, parent=None):
+        template = environment.get_template(name, parent=parent)
+        if template.name in loaded:
+            return
+        loaded.add(template.name)
+        source = environment.loader.get_source(environment, template.name)[0]
+        for reference in meta.find_referenced_templates(
+                environment.parse(source)):
+            # None is a name only known at render time.
+            if reference is not None:
+                load(reference, parent=template.name)
+
+    for name in template_names() if names is None else names:
+        load(name)
+    return len(loaded)
+
+
+def get_environment(registry):
+    return registry.getUtility(IJinja2Environment, name='.jinja2')
+
+
+def preload_templates(event):
+    load_templates(get_environment(event.app.registry))
+
+
+def includeme(config):
+    settings = config.get_settings()
+    directory = settings.get('jinja2.bytecode_caching_directory')
+    if asbool(settings.get('jinja2.bytecode_caching', False)) and directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    if asbool(settings.get('templates.preload', False)):
+        config.add_subscriber(preload_templates, ApplicationCreated)
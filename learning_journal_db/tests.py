@@ -1,22 +1,58 @@
 import pytest
 import transaction
 from pyramid import testing
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPNotFound, HTTPConflict, HTTPUnprocessableEntity
+)
 from .models import (
+    get_replica_engines,
+    transaction_needed,
     get_engine,
     get_session_factory,
     get_tm_session,
 )
 from .models.mymodel import MyModel
+from .models.user import User
+from .models.revision import EntryRevision
+from .models.search import fts5_query, highlight
+from .models.archive import add_to_archive, archive_months, rebuild_archive
+from .models.tag import TagCount, parse_tags, set_entry_tags
 from .models.meta import Base
+from .models.routing import ReplicaSet
+from .views.api import create_entries, update_entries
 from .views.default import (
-    detail, create, lists, update, add_new_model
+    detail, create, lists, update, add_new_model, update_model, history,
+    search, export, tag, tags, archive
 )
+from .scripts.migratedb import parse_legacy_date
+from .scripts.bulkdata import Checkpoint, export_entries, import_records
+from .journal_io import RecordWriter, iter_jsonl, read_records
 from passlib.apps import custom_app_context
-from .security import check_credentials
+from .security import (
+    CachedUser, LoginThrottle, PasswordVerifier, UserCache, check_credentials,
+    get_user, hash_password
+)
+from .cache import RenderCache, invalidate_after_commit
+from .metrics import Histogram, Metrics, RequestStats
+from .markup import RENDERER_VERSION, make_excerpt, render_body
+import datetime
+import io
+import json
 import os
+import zipfile
 
 DB_SETTINGS = {'sqlalchemy.url': 'sqlite:///:memory:'}
 
+# The owner of the entries the tests make; a row in every test database.
+TEST_USER = CachedUser(1, u'user')
+
+
+def add_test_user(engine):
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert().values(
+            id=TEST_USER.id, username=TEST_USER.username,
+            password_hash=u'', created_at=datetime.datetime(2016, 8, 21)))
+
 
 @pytest.fixture(scope='session')
 def sqlengine(request):
@@ -26,6 +62,7 @@ def sqlengine(request):
     settings = config.get_settings()
     engine = get_engine(settings)
     Base.metadata.create_all(engine)
+    add_test_user(engine)
 
     def teardown():
         testing.tearDown()
@@ -49,14 +86,34 @@ def new_session(sqlengine, request):
 
 
 @pytest.fixture()
-def app():
+def app_settings(tmpdir):
+    """Settings of an app with a fresh on-disk SQLite database."""
+    settings = {'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('app.sqlite')}
+    engine = get_engine(settings)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    return settings
+
+
+@pytest.fixture()
+def app(app_settings):
     '''testapp fixture'''
     from learning_journal_db import main
-    app = main({}, **DB_SETTINGS)
+    app = main({}, **app_settings)
     from webtest import TestApp
     return TestApp(app)
 
 
+@pytest.fixture()
+def app_session(app_settings):
+    """A session on the database of the app fixture."""
+    engine = get_engine(app_settings)
+    dbsession = get_session_factory(engine)()
+    yield dbsession
+    dbsession.close()
+    engine.dispose()
+
+
 # Testing security
 PRIVATE_ROUTES = [
     ('/list'),
@@ -87,35 +144,53 @@ def test_no_access_to_private_views_if_no_auth(route, app):
 
 
 @pytest.fixture()
-def auth_env():
+def auth_env(app_session):
     username = 'user'
     password = 'password'
-    os.environ['AUTH_USERNAME'] = username
-    os.environ['AUTH_PASSWORD'] = custom_app_context.encrypt(password)
+    app_session.add(User(username=username,
+                         password_hash=hash_password(password)))
+    app_session.commit()
     return username, password
 
 
-def test_check_cred(auth_env):
+def test_check_cred(auth_env, app_session):
     """
     Test that check_credentials() returns True
     when user's credentials match stored values.
     """
     act_user, act_pass = auth_env
-    assert check_credentials(act_user, act_pass)
+    assert check_credentials(app_session, act_user, act_pass)
 
 
-def test_bad_password_fails_check_cred(auth_env):
+def test_bad_password_fails_check_cred(auth_env, app_session):
     """Test that check_credentials() returns False for a bad password."""
     act_user, act_pass = auth_env
     fake_pass = act_pass + 'aaa'
-    assert not check_credentials(act_user, fake_pass)
+    assert not check_credentials(app_session, act_user, fake_pass)
 
 
-def test_bad_username_fails_check_cred(auth_env):
+def test_bad_username_fails_check_cred(auth_env, app_session):
     """Test that check_credentials() returns False for a bad username."""
     act_user, act_pass = auth_env
     fake_user = act_user + 'aaa'
-    assert not check_credentials(fake_user, act_pass)
+    assert not check_credentials(app_session, fake_user, act_pass)
+
+
+def test_unknown_username_is_hashed_like_a_known_one(auth_env, app_session,
+                                                    monkeypatch):
+    """Test that check_credentials() verifies a hash of the same kind for
+    an unknown username as for a known one, so both take as long."""
+    from . import security
+    checked = []
+
+    def verify_password(password, stored_hash):
+        checked.append(stored_hash.split('$')[1])
+        return False
+    monkeypatch.setattr(security, 'verify_password', verify_password)
+    act_user, act_pass = auth_env
+    assert not check_credentials(app_session, act_user, act_pass)
+    assert not check_credentials(app_session, act_user + 'aaa', act_pass)
+    assert len(checked) == 2 and checked[0] == checked[1]
 
 
 def test_auth_user_redirected_after_login(app, auth_env):
@@ -153,30 +228,138 @@ def test_unauth_user_fails_login_error_msg(app, auth_env):
     assert "Please try again" in response.text
 
 
+def test_login_throttle_rejects_after_max_attempts():
+    """Test that LoginThrottle turns a key away after max_attempts."""
+    throttle = LoginThrottle(max_attempts=2, window=60)
+    assert throttle.attempt('user')
+    assert throttle.attempt('user')
+    assert not throttle.attempt('user')
+    assert throttle.attempt('other')
+    throttle.reset('user')
+    assert throttle.attempt('user')
+
+
+def test_login_flood_gets_429(app):
+    """Test that repeated logins for one username are rejected with 429."""
+    auth_data = {'username': 'flood', 'password': 'password'}
+    for i in range(5):
+        app.post('/login', params=auth_data, status=200)
+    response = app.post('/login', params=auth_data, status=429)
+    assert "Too many login attempts" in response.text
+
+
+def test_login_flood_doesnt_lock_out_other_addresses(app, auth_env):
+    """Test that failed logins from one address don't keep the user from
+    logging in from another."""
+    act_user, act_pass = auth_env
+    attacker = {'REMOTE_ADDR': '192.0.2.1'}
+    auth_data = {'username': act_user, 'password': act_pass + 'fake'}
+    for i in range(5):
+        app.post('/login', params=auth_data, extra_environ=attacker,
+                 status=200)
+    app.post('/login', params=auth_data, extra_environ=attacker,
+             status=429)
+    auth_data['password'] = act_pass
+    app.post('/login', params=auth_data,
+             extra_environ={'REMOTE_ADDR': '198.51.100.7'}, status=302)
+
+
+def test_user_cache_expires_and_evicts():
+    """Test that UserCache keeps the most recent users for ttl seconds."""
+    cache = UserCache(ttl=60, max_entries=2)
+    for i in range(3):
+        cache.put(CachedUser(i, u'u%d' % i))
+    assert cache.get(u'u0') is None
+    assert cache.get(u'u2') == CachedUser(2, u'u2')
+    cache.invalidate(u'u2')
+    assert cache.get(u'u2') is None
+    expired = UserCache(ttl=-1)
+    expired.put(CachedUser(1, u'u1'))
+    assert expired.get(u'u1') is None
+
+
+def test_user_lookup_is_cached(app, auth_env, app_session):
+    """Test that a logged in user's row isn't read on every request."""
+    act_user, act_pass = auth_env
+    app.post('/login', params={'username': act_user, 'password': act_pass},
+             status=302)
+    app.get('/list', status=200)
+    app_session.query(User).delete()
+    app_session.commit()
+    app.get('/list', status=200)
+    app.app.registry['user_cache'].invalidate(act_user)
+    app.get('/list', status=403)
+
+
+def test_password_verifier_in_process_pool():
+    """Test that PasswordVerifier checks hashes in its process pool."""
+    stored = custom_app_context.encrypt('password')
+    verifier = PasswordVerifier(workers=1)
+    assert verifier.verify('user', 'password', stored)
+    assert not verifier.verify('user', 'wrong', stored)
+    verifier._pool.shutdown()
+
+
+def test_password_verifier_caches_successes(monkeypatch):
+    """Test that a cached verification skips hashing until it expires."""
+    stored = custom_app_context.encrypt('password')
+    verifier = PasswordVerifier(cache_ttl=60)
+    assert verifier.verify('user', 'password', stored)
+    monkeypatch.setattr(
+        'learning_journal_db.security.verify_password',
+        lambda password, stored_hash: False)
+    assert verifier.verify('user', 'password', stored)
+    assert not verifier.verify('user', 'other', stored)
+
+
 # Testing the models.
 
 
 def test_model_gets_added(new_session):
     """Test the creation of the new model."""
     assert len(new_session.query(MyModel).all()) == 0
-    model = MyModel(title="test_day", body="test_body")
+    model = MyModel(owner_id=TEST_USER.id, title="test_day", body="test_body")
     new_session.add(model)
     new_session.flush()
     assert len(new_session.query(MyModel).all()) == 1
 
 
+def test_model_gets_timestamps(new_session):
+    """Test that a new model gets created_at and updated_at set."""
+    model = MyModel(owner_id=TEST_USER.id, title="test_day", body="test_body")
+    new_session.add(model)
+    new_session.flush()
+    assert isinstance(model.created_at, datetime.datetime)
+    assert isinstance(model.updated_at, datetime.datetime)
+
+
+LEGACY_DATES = [
+    ('Sun, 18 Oct 2026 12:00:00 GMT', datetime.datetime(2026, 10, 18, 12)),
+    ('Sun, 18 Oct 2026 14:00:00 +0200', datetime.datetime(2026, 10, 18, 12)),
+    ('August 21, 2016', datetime.datetime(2016, 8, 21)),
+    ('not a date', None),
+    (None, None),
+]
+
+
+@pytest.mark.parametrize('value, expected', LEGACY_DATES)
+def test_parse_legacy_date(value, expected):
+    """Test that legacy date strings are parsed into UTC datetimes."""
+    assert parse_legacy_date(value) == expected
+
+
 # Testing the views.
 
 
 def dummy_http_request(new_session):
-    test_request = testing.DummyRequest()
+    test_request = testing.DummyRequest(user=TEST_USER)
     test_request.dbsession = new_session
     return test_request
 
 
 def dummy_http_request_post(title, body, new_session):
     """Define a dummy request with method="POST"."""
-    test_request = testing.DummyRequest()
+    test_request = testing.DummyRequest(user=TEST_USER)
     test_request.dbsession = new_session
     test_request.method = 'POST'
     test_request.POST['title'] = title
@@ -193,19 +376,78 @@ ATTR_VAL = [
 @pytest.mark.parametrize('attr, val', ATTR_VAL)
 def test_lists(attr, val, new_session):
     """Test whether lists() pull out correct info from db."""
-    new_session.add(MyModel(title='test1', body='test2'))
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='test1', body='test2'))
     new_session.flush()
     result = lists(dummy_http_request(new_session))
     for entry in result['entries']:
         assert getattr(entry, attr) == val
 
 
+def test_lists_does_not_load_body(new_session):
+    """Test that lists() leaves the body column unloaded."""
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='test1', body='test2'))
+    new_session.flush()
+    result = lists(dummy_http_request(new_session))
+    assert 'body' not in result['entries'][0].__dict__
+
+
+def test_lists_shows_stored_excerpt_without_body(new_session):
+    """Test that lists() gets excerpts and word counts, but no bodies."""
+    new_session.add(rendered_entry('title', u'Some *short* notes.'))
+    new_session.flush()
+    new_session.expire_all()
+    entry = lists(dummy_http_request(new_session))['entries'][0]
+    assert 'body' not in entry.__dict__
+    assert 'body_html' not in entry.__dict__
+    assert entry.excerpt == u'Some short notes.'
+    assert (entry.word_count, entry.reading_minutes) == (3, 1)
+
+
+def test_make_excerpt_cuts_at_sentence_or_word():
+    """Test that long texts are cut after a sentence when one ends late
+    enough, and after a word otherwise."""
+    sentences = u'First sentence here. ' + u'word ' * 20
+    assert make_excerpt(sentences, 30) == u'First sentence here.'
+    assert make_excerpt(u'short text', 30) == u'short text'
+    assert make_excerpt(u'Hi. ' + u'words ' * 10, 30) == (
+        u'Hi. words words words words\u2026')
+
+
+def test_lists_keyset_pagination(new_session):
+    """Test that lists() pages newest first using after/before cursors."""
+    for i in range(5):
+        new_session.add(MyModel(owner_id=TEST_USER.id,
+                                title='day%d' % i, body='body'))
+    new_session.flush()
+    request = testing.DummyRequest(user=TEST_USER, params={'limit': '2'})
+    request.dbsession = new_session
+    first = lists(request)
+    assert [e.title for e in first['entries']] == ['day4', 'day3']
+    assert first['prev_before'] is None
+
+    request = testing.DummyRequest(
+        user=TEST_USER,
+        params={'limit': '2', 'after': str(first['next_after'])})
+    request.dbsession = new_session
+    second = lists(request)
+    assert [e.title for e in second['entries']] == ['day2', 'day1']
+
+    request = testing.DummyRequest(
+        user=TEST_USER,
+        params={'limit': '2', 'before': str(second['prev_before'])})
+    request.dbsession = new_session
+    back = lists(request)
+    assert [e.title for e in back['entries']] == ['day4', 'day3']
+
+
 def test_create(new_session):
     """
     Test whether create() returns appropriate values
     on 'GET' request.
     """
-    assert create(dummy_http_request(new_session)) == {'error_msg': '', 'session': {'body': '', 'title': ''}}
+    assert create(dummy_http_request(new_session)) == {'error_msg': '', 'session': {'body': '', 'title': '', 'tags': ''}}
 
 
 def test_create_error(new_session):
@@ -233,7 +475,8 @@ def test_add_new_model(attr, val, new_session):
 @pytest.mark.parametrize('attr, val', ATTR_VAL)
 def test_detail_get(attr, val, new_session):
     """Test whether right details are returned upon calling detail()."""
-    new_session.add(MyModel(title='test1', body='test2'))
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='test1', body='test2'))
     new_session.flush()
     request = dummy_http_request(new_session)
     request.matchdict['id'] = 1
@@ -244,11 +487,1151 @@ def test_detail_get(attr, val, new_session):
 @pytest.mark.parametrize('attr, val', ATTR_VAL)
 def test_update_get(val, attr, new_session):
     """Test whether right details are returned upon calling update()."""
-    new_session.add(MyModel(title='test1', body='test2'))
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='test1', body='test2'))
     new_session.flush()
     request = dummy_http_request(new_session)
     request.matchdict['id'] = 1
     assert update(request) == {
-        'entry': {'title': 'test1', 'body': 'test2', 'id': 1},
+        'entry': {'title': 'test1', 'body': 'test2', 'tags': '', 'id': 1},
         'error_msg': ''
     }
+
+
+def test_update_model_edits_in_place(new_session):
+    """Test that update_model() changes the row and keeps the old version."""
+    entry = MyModel(owner_id=TEST_USER.id, title='test1', body='test2')
+    new_session.add(entry)
+    new_session.flush()
+    request = dummy_http_request_post('new title', 'new body', new_session)
+    update_model(request, entry)
+    new_session.flush()
+    assert new_session.query(MyModel).count() == 1
+    assert entry.title == 'new title'
+    assert entry.version == 2
+    revision = new_session.query(EntryRevision).one()
+    assert revision.version == 1
+    assert revision.title == 'test1'
+    assert revision.body == 'test2'
+
+
+def test_history(new_session):
+    """Test that history() returns earlier versions, newest first."""
+    entry = MyModel(owner_id=TEST_USER.id, title='v1', body='body')
+    new_session.add(entry)
+    new_session.flush()
+    for title in ('v2', 'v3'):
+        request = dummy_http_request_post(title, 'body', new_session)
+        update_model(request, entry)
+        new_session.flush()
+    request = dummy_http_request(new_session)
+    request.matchdict['id'] = entry.id
+    result = history(request)
+    assert [r.title for r in result['revisions']] == ['v2', 'v1']
+
+
+def test_history_pages_revisions(new_session):
+    """Test that history() pages through the revisions by version."""
+    entry = MyModel(owner_id=TEST_USER.id, title='v1', body='body')
+    new_session.add(entry)
+    new_session.flush()
+    for version in range(2, 7):
+        request = dummy_http_request_post('v%d' % version, 'body',
+                                          new_session)
+        update_model(request, entry)
+        new_session.flush()
+
+    def page(**params):
+        request = testing.DummyRequest(user=TEST_USER, params=dict(
+            limit='2', **dict((k, str(v)) for k, v in params.items())))
+        request.dbsession = new_session
+        request.matchdict['id'] = entry.id
+        return history(request)
+    first = page()
+    assert [r.version for r in first['revisions']] == [5, 4]
+    assert (first['prev_before'], first['next_after']) == (None, 4)
+    second = page(after=first['next_after'])
+    assert [r.version for r in second['revisions']] == [3, 2]
+    last = page(after=second['next_after'])
+    assert [r.version for r in last['revisions']] == [1]
+    assert last['next_after'] is None
+    back = page(before=last['prev_before'])
+    assert [r.version for r in back['revisions']] == [3, 2]
+
+
+def test_entries_are_private_to_their_owner(new_session):
+    """Test that users only see and edit their own entries."""
+    new_session.add(User(id=2, username=u'other', password_hash=u''))
+    new_session.add(MyModel(owner_id=TEST_USER.id, title='mine', body='b'))
+    new_session.add(MyModel(owner_id=2, title='theirs', body='b'))
+    new_session.flush()
+    result = lists(dummy_http_request(new_session))
+    assert [e.title for e in result['entries']] == ['mine']
+    for view in (detail, update, history):
+        request = dummy_http_request(new_session)
+        request.matchdict['id'] = 2
+        with pytest.raises(HTTPNotFound):
+            view(request)
+    request = testing.DummyRequest(user=TEST_USER, params={'q': 'theirs'})
+    request.dbsession = new_session
+    assert search(request)['results'] == []
+
+
+def dated_entry(title, created_at):
+    """Return an entry of the test user created at ``created_at``."""
+    return MyModel(owner_id=TEST_USER.id, title=title, body='body',
+                   created_at=created_at, updated_at=created_at)
+
+
+def test_archive_counts_new_entries(new_session):
+    """Test that creating entries adds to the archive of their month."""
+    add_new_model(dummy_http_request_post('one', 'body', new_session))
+    add_new_model(dummy_http_request_post('two', 'body', new_session))
+    add_to_archive(new_session, TEST_USER.id,
+                   [datetime.datetime(2016, 8, 21)])
+    now = datetime.datetime.utcnow()
+    assert archive_months(new_session, TEST_USER.id) == [
+        (now.year, now.month, 2), (2016, 8, 1)]
+
+
+def test_rebuild_archive_recounts_entries(new_session):
+    """Test that rebuild_archive() replaces the counts with the real ones."""
+    add_to_archive(new_session, TEST_USER.id,
+                   [datetime.datetime(2015, 1, 1)])
+    new_session.add_all([
+        dated_entry('a', datetime.datetime(2016, 8, 21)),
+        dated_entry('b', datetime.datetime(2016, 8, 31, 23, 59)),
+        dated_entry('c', datetime.datetime(2016, 12, 1)),
+    ])
+    new_session.flush()
+    assert rebuild_archive(new_session.connection()) == 2
+    assert archive_months(new_session, TEST_USER.id) == [
+        (2016, 12, 1), (2016, 8, 2)]
+
+
+def test_archive_shows_one_month(new_session):
+    """Test that archive() lists the entries of one month only."""
+    new_session.add_all([
+        dated_entry('july', datetime.datetime(2016, 7, 31, 23, 59)),
+        dated_entry('aug1', datetime.datetime(2016, 8, 1)),
+        dated_entry('aug2', datetime.datetime(2016, 8, 31, 12)),
+        dated_entry('sep', datetime.datetime(2016, 9, 1)),
+    ])
+    new_session.flush()
+    rebuild_archive(new_session.connection())
+    request = dummy_http_request(new_session)
+    request.matchdict.update(year='2016', month='8')
+    result = archive(request)
+    assert [e.title for e in result['entries']] == ['aug2', 'aug1']
+    assert result['title'] == 'August 2016'
+    assert [label for label, y, m, count in result['archive']] == \
+        ['September 2016', 'August 2016', 'July 2016']
+    for year, month in [('2016', '13'), ('0000', '1'), ('9999', '12')]:
+        request.matchdict.update(year=year, month=month)
+        with pytest.raises(HTTPNotFound):
+            archive(request)
+
+
+def tagged_post(title, tag_names, new_session):
+    """Define a dummy POST request with a "tags" field."""
+    request = dummy_http_request_post(title, 'body', new_session)
+    request.POST['tags'] = tag_names
+    return request
+
+
+def test_parse_tags():
+    """Test that tags are split on commas, normalized and deduplicated."""
+    assert parse_tags(u'Python, web  dev,,python\nSQL ') == \
+        [u'python', u'web-dev', u'sql']
+    assert parse_tags(None) == []
+
+
+def test_set_entry_tags_keeps_counts(new_session):
+    """Test that tag counts follow entries being tagged and untagged."""
+    first = add_new_model(tagged_post('a', 'python, sql', new_session))
+    add_new_model(tagged_post('b', 'python', new_session))
+    counts = dict((t.tag_id, t.entries) for t in new_session.query(TagCount))
+    assert sorted(counts.values()) == [1, 2]
+    assert set_entry_tags(new_session, first['entry'], [u'web']) is True
+    assert set_entry_tags(new_session, first['entry'], [u'web']) is False
+    result = tags(dummy_http_request(new_session))
+    assert [(name, count) for name, count, size in result['tags']] == \
+        [(u'python', 1), (u'web', 1)]
+
+
+@pytest.mark.parametrize('upsert', [True, False])
+def test_tag_added_concurrently_is_reused(upsert, file_session_factory,
+                                          monkeypatch):
+    """Test that a tag another request adds between the lookup and the
+    insert is used instead of failing on the unique index."""
+    from sqlalchemy import event
+    from .models import Tag
+    from .models import tag as tag_module
+    if not upsert:
+        # As on a database without INSERT ... ON CONFLICT.
+        monkeypatch.setattr(tag_module, 'UPSERT_INSERTS', {})
+    session = file_session_factory()
+    engine = session.get_bind()
+    other = get_engine({'sqlalchemy.url': str(engine.url)})
+    added = []
+
+    def add_first(conn, cursor, statement, parameters, context, many):
+        if statement.startswith('INSERT INTO tags') and not added:
+            added.append(True)
+            with other.begin() as connection:
+                connection.execute(Tag.__table__.insert().values(
+                    owner_id=TEST_USER.id, name=u'python'))
+    event.listen(engine, 'before_cursor_execute', add_first)
+    try:
+        tags = tag_module._get_or_create_tags(session, TEST_USER.id,
+                                              [u'python', u'sql'])
+        session.commit()
+    finally:
+        event.remove(engine, 'before_cursor_execute', add_first)
+    assert sorted(tag.name for tag in tags) == [u'python', u'sql']
+    assert session.query(Tag).count() == 2
+    assert session.query(TagCount).count() == 2
+    session.close()
+    other.dispose()
+
+
+def test_tag_pages_entries_newest_first(new_session):
+    """Test that tag() pages through the entries with a tag only."""
+    for day in range(1, 6):
+        add_new_model(tagged_post('day%d' % day,
+                                  'even' if day % 2 else 'odd, even',
+                                  new_session))
+        new_session.flush()
+    request = testing.DummyRequest(user=TEST_USER, params={'limit': '2'})
+    request.dbsession = new_session
+    request.matchdict['name'] = 'even'
+    first = tag(request)
+    assert [e.title for e in first['entries']] == ['day5', 'day4']
+    request = testing.DummyRequest(
+        user=TEST_USER,
+        params={'limit': '2', 'after': str(first['next_after'])})
+    request.dbsession = new_session
+    request.matchdict['name'] = 'even'
+    second = tag(request)
+    assert [e.title for e in second['entries']] == ['day3', 'day2']
+    request.matchdict['name'] = 'missing'
+    with pytest.raises(HTTPNotFound):
+        tag(request)
+
+
+def test_update_model_tags_only_makes_new_version(new_session):
+    """Test that changing only the tags changes the entry's version."""
+    entry = add_new_model(tagged_post('t', 'one', new_session))['entry']
+    new_session.flush()
+    update_model(tagged_post('t', 'one, two', new_session), entry)
+    new_session.flush()
+    assert entry.version == 2
+    assert new_session.query(EntryRevision).count() == 0
+    # A form without the field leaves the tags alone.
+    update_model(dummy_http_request_post('t', 'body', new_session), entry)
+    new_session.flush()
+    assert entry.version == 2
+
+
+def api_request(new_session, entries):
+    """Define a dummy API request carrying ``entries`` as its JSON body."""
+    request = testing.DummyRequest(user=TEST_USER)
+    request.dbsession = new_session
+    request.json_body = {'entries': entries}
+    return request
+
+
+def test_api_create_entries(new_session):
+    """Test that create_entries() inserts a batch and returns the ids."""
+    result = create_entries(api_request(new_session, [
+        {'title': 'one', 'body': '*a*'},
+        {'title': 'two', 'body': 'b', 'created_at': '2016-01-02T03:04:05'},
+    ]))
+    ids = [e['id'] for e in result['entries']]
+    entries = new_session.query(MyModel).order_by(MyModel.id).all()
+    assert ids == [e.id for e in entries]
+    assert [e['version'] for e in result['entries']] == [1, 1]
+    assert entries[0].body_html == u'<p><em>a</em></p>'
+    assert entries[1].created_at == datetime.datetime(2016, 1, 2, 3, 4, 5)
+
+
+def test_api_update_entries(new_session):
+    """Test that update_entries() edits a batch and keeps revisions."""
+    new_session.add_all([MyModel(owner_id=TEST_USER.id,
+                                 title='t%d' % i, body='b', version=1)
+                         for i in range(3)])
+    new_session.flush()
+    result = update_entries(api_request(new_session, [
+        {'id': 1, 'title': 'new', 'version': 1},
+        {'id': 2, 'body': 'new body'},
+        {'id': 3, 'title': 't2'},
+    ]))
+    assert result['entries'] == [{'id': 1, 'version': 2},
+                                 {'id': 2, 'version': 2},
+                                 {'id': 3, 'version': 1}]
+    new_session.expire_all()
+    first, second = new_session.query(MyModel).order_by(MyModel.id)[:2]
+    assert first.title == 'new'
+    assert second.body_html == u'<p>new body</p>'
+    assert new_session.query(EntryRevision).count() == 2
+
+
+@pytest.mark.parametrize('entries, error', [
+    ([{'id': 1, 'title': 'x', 'version': 2}], HTTPConflict),
+    ([{'id': 1, 'title': 'x'}, {'id': 9, 'title': 'y'}],
+     HTTPUnprocessableEntity),
+    ([{'id': 1, 'title': 'x'}, {'id': 1, 'title': 'y'}], HTTPBadRequest),
+    ([{'id': 1, 'title': ''}], HTTPBadRequest),
+])
+def test_api_update_rejects_whole_batch(entries, error, new_session):
+    """Test that an invalid item stops the batch before anything is
+    written."""
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='t', body='b', version=1))
+    new_session.flush()
+    with pytest.raises(error) as info:
+        update_entries(api_request(new_session, entries))
+    assert 'error' in info.value.json_body
+    assert new_session.query(MyModel.title).scalar() == 't'
+
+
+def test_fts5_query_quotes_words():
+    """Test that user input can't inject FTS5 query syntax."""
+    assert fts5_query('pyramid AND "heaps" -x') == \
+        '"pyramid" "AND" "heaps" "x"'
+
+
+def test_highlight_escapes_snippet():
+    """Test that highlight() escapes text and marks the matches."""
+    snippet = u'<b>learned</b> about \x02Pyramid\x03'
+    assert highlight(snippet) == \
+        '&lt;b&gt;learned&lt;/b&gt; about <mark>Pyramid</mark>'
+
+
+def test_search_finds_ranked_matches(new_session):
+    """Test that search() returns matching entries with snippets."""
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='Heaps', body='Today I learned heaps.'))
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='Day2', body='Heaps and templates.'))
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='Day3', body='Deploying to Heroku.'))
+    new_session.flush()
+    request = testing.DummyRequest(user=TEST_USER, params={'q': 'heaps'})
+    request.dbsession = new_session
+    result = search(request)
+    assert [r.title for r in result['results']] == ['Heaps', 'Day2']
+    assert '<mark>heaps</mark>' in result['results'][0].snippet
+    assert result['next_page'] is None
+
+
+def test_search_index_follows_edits(new_session):
+    """Test that an edited entry is found by its new words only."""
+    entry = MyModel(owner_id=TEST_USER.id, title='Day1', body='pyramid')
+    new_session.add(entry)
+    new_session.flush()
+    update_model(dummy_http_request_post('Day1', 'heroku', new_session),
+                 entry)
+    new_session.flush()
+    request = testing.DummyRequest(user=TEST_USER, params={'q': 'pyramid'})
+    request.dbsession = new_session
+    assert search(request)['results'] == []
+    request = testing.DummyRequest(user=TEST_USER, params={'q': 'heroku'})
+    request.dbsession = new_session
+    assert [r.id for r in search(request)['results']] == [entry.id]
+
+
+def test_render_body_sanitizes_markdown():
+    """Test that bodies are rendered from Markdown with scripts removed."""
+    html = render_body(u'Some *notes*\n\n<script>alert(1)</script>'
+                       u'[x](javascript:alert(1))')
+    assert '<em>notes</em>' in html
+    assert '<script>' not in html
+    assert 'javascript:' not in html
+
+
+def test_add_new_model_stores_rendered_body(new_session):
+    """Test that the HTML of a new entry is rendered when it is saved."""
+    entry = add_new_model(
+        dummy_http_request_post('title', u'# Heading', new_session))['entry']
+    new_session.flush()
+    assert entry.body_html == u'<h1>Heading</h1>'
+    assert entry.body_html_version == RENDERER_VERSION
+
+
+def test_detail_page_outputs_stored_html(new_session):
+    """Test that the entry page shows body_html without rendering it."""
+    from learning_journal_db import main
+    from pyramid.renderers import render
+    from pyramid.scripting import prepare
+    entry = rendered_entry('title', u'**bold**')
+    entry.body_html = u'<p>stored</p>'
+    new_session.add(entry)
+    new_session.flush()
+    env = prepare(registry=main({}, **DB_SETTINGS).registry)
+    try:
+        page = render('learning_journal_db:templates/single_entry.jinja2',
+                      {'entry': entry}, request=env['request'])
+    finally:
+        env['closer']()
+    assert '<p>stored</p>' in page
+    assert '<strong>' not in page
+
+
+def rendered_entry(title, body):
+    entry = MyModel(owner_id=TEST_USER.id, title=title)
+    entry.set_body(body)
+    return entry
+
+
+def test_detail_sets_validators(new_session):
+    """Test that detail() sets an ETag and Last-Modified on the response."""
+    new_session.add(rendered_entry('test1', 'test2'))
+    new_session.flush()
+    request = dummy_http_request(new_session)
+    request.matchdict['id'] = 1
+    detail(request)
+    assert request.response.etag == 'entry-1-1-%s' % RENDERER_VERSION
+    assert request.response.last_modified is not None
+
+
+def test_detail_if_none_match_gets_304(new_session):
+    """Test that detail() answers a current If-None-Match with a 304."""
+    new_session.add(rendered_entry('test1', 'test2'))
+    new_session.flush()
+    request = dummy_http_request(new_session)
+    request.matchdict['id'] = 1
+    request.headers['If-None-Match'] = '"entry-1-1-%s"' % RENDERER_VERSION
+    assert detail(request).status_code == 304
+
+
+def test_detail_stale_etag_renders(new_session):
+    """Test that detail() renders the entry again once it is edited."""
+    entry = rendered_entry('test1', 'test2')
+    new_session.add(entry)
+    new_session.flush()
+    update_model(dummy_http_request_post('new', 'new', new_session), entry)
+    new_session.flush()
+    request = dummy_http_request(new_session)
+    request.matchdict['id'] = 1
+    request.headers['If-None-Match'] = '"entry-1-1-%s"' % RENDERER_VERSION
+    assert detail(request)['entry'].title == 'new'
+
+
+def test_lists_if_modified_since_gets_304(new_session):
+    """Test that lists() answers a current If-Modified-Since with a 304."""
+    new_session.add(MyModel(owner_id=TEST_USER.id,
+                            title='test1', body='test2'))
+    new_session.flush()
+    request = dummy_http_request(new_session)
+    lists(request)
+    last_modified = request.response.headers['Last-Modified']
+    etag = request.response.headers['ETag']
+
+    request = dummy_http_request(new_session)
+    request.headers['If-Modified-Since'] = last_modified
+    assert lists(request).status_code == 304
+
+    request = dummy_http_request(new_session)
+    request.headers['If-None-Match'] = etag
+    assert lists(request).status_code == 304
+
+
+def test_list_validators_read_each_max_from_an_index(new_session):
+    """Test that the validators of list pages don't scan the user's
+    entries: each max is read from its own (owner_id, column) index."""
+    from sqlalchemy import event
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    engine = new_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        request = dummy_http_request(new_session)
+        request.headers['If-None-Match'] = '"x"'
+        lists(request)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    statement, parameters = statements[0]
+    plan = [row[-1] for row in new_session.connection().exec_driver_sql(
+        'EXPLAIN QUERY PLAN ' + statement, parameters)]
+    for index in ('id', 'updated_at', 'rendered_at'):
+        assert ('SEARCH models USING COVERING INDEX '
+                'ix_models_owner_id_%s (owner_id=?)' % index) in plan
+
+
+def test_render_cache_hits_current_version_only():
+    """Test that RenderCache only returns the page of the cached version."""
+    cache = RenderCache()
+    cache.put(1, 1, b'page')
+    assert cache.get(1, 1) == b'page'
+    assert cache.get(1, 2) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_render_cache_evicts_lru_within_limits():
+    """Test that RenderCache evicts least recently used pages."""
+    cache = RenderCache(max_entries=2, max_bytes=10)
+    cache.put(1, 1, b'aaaa')
+    cache.put(2, 1, b'bbbb')
+    cache.get(1, 1)
+    cache.put(3, 1, b'cccc')
+    assert cache.get(2, 1) is None
+    assert cache.get(1, 1) == b'aaaa'
+    cache.put(4, 1, b'dddddddd')
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['bytes'] == 8
+    assert cache.stats()['evictions'] == 3
+
+
+def test_render_cache_invalidated_on_commit_only():
+    """Test that a cached page is only dropped when the transaction commits."""
+    cache = RenderCache()
+    request = testing.DummyRequest()
+    request.registry['render_cache'] = cache
+    request.tm = transaction.TransactionManager()
+    try:
+        cache.put(1, 1, b'page')
+        request.tm.begin()
+        invalidate_after_commit(request, 1)
+        request.tm.abort()
+        assert cache.get(1, 1) == b'page'
+        request.tm.begin()
+        invalidate_after_commit(request, 1)
+        request.tm.commit()
+        assert cache.get(1, 1) is None
+    finally:
+        del request.registry['render_cache']
+
+
+@pytest.fixture()
+def file_session_factory(tmpdir):
+    """A session factory for a fresh on-disk SQLite database."""
+    engine = get_engine(
+        {'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('bulk.sqlite')})
+    Base.metadata.create_all(engine)
+    add_test_user(engine)
+    yield get_session_factory(engine)
+    engine.dispose()
+
+
+def test_import_resumes_from_checkpoint(file_session_factory, tmpdir):
+    """Test that import_records() skips records a checkpoint covers."""
+    records = [{'title': 'day%d' % i, 'body': 'body'} for i in range(5)]
+    checkpoint = Checkpoint(str(tmpdir.join('checkpoint')), 'source')
+    checkpoint.save(2)
+    done = import_records(file_session_factory, iter(records), TEST_USER.id,
+                          batch_size=2, checkpoint=checkpoint)
+    assert done == 5
+    assert checkpoint.load() == 5
+    dbsession = file_session_factory()
+    titles = [e.title for e in dbsession.query(MyModel).order_by(MyModel.id)]
+    dbsession.close()
+    assert titles == ['day2', 'day3', 'day4']
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+def test_export_then_import_round_trip(fmt, file_session_factory):
+    """Test that exported records import back as the same entries."""
+    import_records(file_session_factory, iter([
+        {'title': u'Day1', 'body': u'Line one\nline "two"',
+         'created_at': '2016-08-21T10:00:00'},
+        {'title': u'Day2', 'body': u'caf\xe9'},
+    ]), TEST_USER.id)
+    stream = io.StringIO()
+    assert export_entries(file_session_factory,
+                          RecordWriter(stream, fmt), batch_size=1) == 2
+    stream.seek(0)
+    records = list(read_records(stream, fmt))
+    assert [r['title'] for r in records] == ['Day1', 'Day2']
+    assert records[0]['body'] == u'Line one\nline "two"'
+    assert records[0]['created_at'] == '2016-08-21T10:00:00.000000'
+    assert records[1]['body'] == u'caf\xe9'
+
+
+def test_iter_entries_releases_connection_between_batches(
+        file_session_factory):
+    """Test that iter_entries() holds no connection while its caller
+    works through a batch."""
+    from .journal_io import iter_entries
+    import_records(file_session_factory, iter(
+        [{'title': 'day%d' % i} for i in range(25)]), TEST_USER.id)
+    dbsession = file_session_factory()
+    pool = dbsession.get_bind().pool
+    titles = []
+    for row in iter_entries(dbsession, batch_size=10):
+        assert pool.checkedout() == 0
+        titles.append(row.title)
+    assert titles == ['day%d' % i for i in range(25)]
+    dbsession.close()
+
+
+def test_iter_jsonl_streams_in_chunks(file_session_factory):
+    """Test that iter_jsonl() yields the journal in several small chunks."""
+    import_records(file_session_factory, iter(
+        [{'title': 'day%d' % i, 'body': 'x' * 100} for i in range(50)]),
+        TEST_USER.id)
+    chunks = list(iter_jsonl(file_session_factory, batch_size=7,
+                             chunk_size=1024))
+    assert len(chunks) > 1
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+    assert [json.loads(line)['title'] for line in lines] == \
+        ['day%d' % i for i in range(50)]
+
+
+def test_iter_jsonl_holds_no_connection_between_chunks(
+        file_session_factory):
+    """Test that a download in progress doesn't keep a pooled connection
+    checked out while the client reads."""
+    import_records(file_session_factory, iter(
+        [{'title': 'day%d' % i, 'body': 'x' * 100} for i in range(50)]),
+        TEST_USER.id)
+    pool = file_session_factory.kw['bind'].pool
+    chunks = iter_jsonl(file_session_factory, batch_size=10,
+                        chunk_size=512)
+    next(chunks)
+    assert pool.checkedout() == 0
+    for i in range(5):
+        next(chunks)
+    assert pool.checkedout() == 0
+    chunks.close()
+
+
+@pytest.mark.parametrize('ext', ['jsonl', 'zip'])
+def test_export_view_streams_journal(ext, file_session_factory,
+                                     monkeypatch):
+    """Test that export() returns the journal as a streamed response."""
+    import_records(file_session_factory, iter([{'title': 'Day1'}]),
+                   TEST_USER.id)
+    request = testing.DummyRequest(user=TEST_USER)
+    monkeypatch.setitem(request.registry, 'dbsession_factory',
+                        file_session_factory)
+    request.matchdict['ext'] = ext
+    response = export(request)
+    body = b''.join(response.app_iter)
+    if ext == 'zip':
+        body = zipfile.ZipFile(io.BytesIO(body)).read('journal.jsonl')
+    assert json.loads(body.decode('utf-8'))['title'] == 'Day1'
+
+
+def test_histogram_buckets_are_cumulative():
+    """Test that Histogram reports cumulative bucket counts."""
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    assert list(histogram.samples()) == [('0.1', 1), ('1.0', 3), ('+Inf', 4)]
+    assert histogram.total == 6.05
+
+
+def test_metrics_render_prometheus_text():
+    """Test that Metrics renders per-route series in Prometheus format."""
+    metrics = Metrics()
+    stats = RequestStats()
+    stats.sql_queries = 3
+    metrics.record('lists', stats, 0.2, slow=True)
+    text = metrics.render([('journal_extra', 'gauge', 'Extra.', 7)])
+    assert 'journal_request_duration_seconds_count{route="lists"} 1' in text
+    assert 'journal_sql_queries_total{route="lists"} 3' in text
+    assert 'journal_slow_requests_total{route="lists"} 1' in text
+    assert 'journal_extra 7' in text
+
+
+def test_requests_are_timed_by_route(app):
+    """Test that the metrics tween records requests by route name."""
+    app.get('/login')
+    metrics = app.app.registry['metrics']
+    assert metrics.requests == {'login': 1}
+
+
+def test_metrics_is_admin_only(app):
+    """Test that /metrics is not visible to anonymous users."""
+    app.get('/metrics', status=403)
+
+
+def test_get_engine_reads_pool_settings():
+    """Test that get_engine() coerces pool options and skips replicas."""
+    engine = get_engine({'sqlalchemy.url': 'sqlite://',
+                         'sqlalchemy.pool_pre_ping': 'false',
+                         'sqlalchemy.replica.url': 'sqlite://'})
+    assert engine.pool._pre_ping is False
+
+
+def test_replica_set_round_robin_skips_failed_replicas(tmpdir):
+    """Test that ReplicaSet.choose() rotates among working replicas."""
+    good = [get_engine({'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join(
+        'replica%d.sqlite' % i)}) for i in range(2)]
+    bad = get_engine({'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join(
+        'missing', 'replica.sqlite')})
+    replicas = ReplicaSet([good[0], bad, good[1]], retry_interval=60)
+    assert [replicas.choose() for _ in range(3)] == [good[0], good[1],
+                                                     good[0]]
+    assert ReplicaSet([bad]).choose() is None
+
+
+def test_read_only_session_reads_from_replica(tmpdir):
+    """Test that read-only sessions query a replica unless pinned to the
+    primary."""
+    settings = {
+        'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('primary.sqlite'),
+        'sqlalchemy.replica.url': 'sqlite:///%s' % tmpdir.join(
+            'replica.sqlite'),
+        'sqlalchemy.replica.retry_interval': '60',
+    }
+    primary = get_engine(settings)
+    replica_engines = get_replica_engines(settings)
+    for engine in [primary] + replica_engines:
+        Base.metadata.create_all(engine)
+    factory = get_session_factory(primary, ReplicaSet(replica_engines))
+    session = factory()
+    session.add(MyModel(owner_id=TEST_USER.id, title='on primary', body=''))
+    session.commit()
+    assert factory(info={'read_only': True}).query(MyModel).count() == 0
+    assert factory(info={'read_only': True, 'replica': None}).query(
+        MyModel).count() == 1
+
+
+@pytest.mark.parametrize('method, path, needed', [
+    ('GET', '/journal/new-entry', False),
+    ('GET', '/static/base.css', False),
+    ('POST', '/login', False),
+    ('POST', '/journal/new-entry', True),
+    ('POST', '/no-such-page', True),
+])
+def test_transaction_needed(method, path, needed, app):
+    """Test that only writes to database routes get a transaction."""
+    request = testing.DummyRequest(path=path, method=method)
+    request.registry = app.app.registry
+    assert transaction_needed(request) is needed
+
+
+def test_get_session_is_read_only(app):
+    """Test that GET requests get a session that refuses to write."""
+    from pyramid.request import Request, apply_request_extensions
+    from sqlalchemy.exc import InvalidRequestError
+    request = Request.blank('/list')
+    request.registry = app.app.registry
+    apply_request_extensions(request)
+    request.dbsession.add(MyModel(owner_id=TEST_USER.id,
+                                  title='lost', body=''))
+    with pytest.raises(InvalidRequestError):
+        request.dbsession.flush()
+
+
+def _asgi_request(app, method, path, headers=(), body=b''):
+    """Send one request to an ASGI app; return (status, body)."""
+    import asyncio
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'', 'http_version': '1.1',
+             'headers': [(k.encode(), v.encode()) for k, v in headers]}
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], b''.join(m.get('body', b'') for m in sent[1:])
+
+
+def test_asgi_app_serves_routes(tmpdir, monkeypatch):
+    """Test that the ASGI front end serves the app with an async session."""
+    pytest.importorskip('aiosqlite')
+    asgi = pytest.importorskip('learning_journal_db.asgi')
+    from pyramid.authentication import AuthTicket
+    monkeypatch.setenv('AUTH_SECRET', 'secret')
+    url = 'sqlite:///%s' % tmpdir.join('asgi.sqlite')
+    engine = get_engine({'sqlalchemy.url': url})
+    Base.metadata.create_all(engine)
+    add_test_user(engine)
+    app = asgi.make_asgi_app({}, **{'sqlalchemy.url': url})
+    cookie = [('Cookie', 'auth_tkt=%s' % AuthTicket(
+        'secret', TEST_USER.username, '0.0.0.0',
+        hashalg='sha512').cookie_value())]
+    form = [('Content-Type', 'application/x-www-form-urlencoded')]
+
+    assert _asgi_request(app, 'GET', '/login')[0] == 200
+    assert _asgi_request(app, 'POST', '/journal/new-entry', cookie + form,
+                         b'title=Async&body=entry')[0] == 302
+    status, body = _asgi_request(app, 'GET', '/journal/1', cookie)
+    assert status == 200
+    assert b'Async' in body
+
+
+def test_forked_process_gets_its_own_pool():
+    """Test that engines start a forked child with an empty pool."""
+    engine = get_engine({'sqlalchemy.url': 'sqlite://'})
+    engine.connect().close()
+    parent_pool = engine.pool
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if engine.pool is not parent_pool else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert engine.pool is parent_pool
+
+
+PREFORK_SCRIPT = """
+import os, sys
+from learning_journal_db.prefork import Arbiter
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+Arbiter(lambda: app, '127.0.0.1', int(sys.argv[1]), workers=2,
+        graceful_timeout=5).run()
+"""
+
+
+def test_prefork_restarts_and_reloads_workers():
+    """Test that the prefork parent replaces dead workers and reloads on
+    SIGHUP, and that it stops on SIGTERM."""
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    from urllib.request import urlopen
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    parent = subprocess.Popen(
+        [sys.executable, '-c', PREFORK_SCRIPT, str(port)],
+        cwd=os.path.dirname(os.path.dirname(__file__)))
+
+    def worker_pids(timeout=10):
+        deadline = time.time() + timeout
+        pids = set()
+        while len(pids) < 2 and time.time() < deadline:
+            try:
+                pids.add(int(urlopen(
+                    'http://127.0.0.1:%d/' % port, timeout=1).read()))
+            except OSError:
+                time.sleep(0.1)
+        return pids
+
+    try:
+        first = worker_pids()
+        assert len(first) == 2
+        os.kill(first.pop(), signal.SIGKILL)
+        time.sleep(1.5)
+        assert len(worker_pids() - first) == 1
+        parent.send_signal(signal.SIGHUP)
+        time.sleep(1.5)
+        second = worker_pids()
+        assert len(second) == 2 and not second & first
+        parent.send_signal(signal.SIGTERM)
+        assert parent.wait(timeout=10) == 0
+    finally:
+        if parent.poll() is None:
+            parent.kill()
+
+
+def test_app_startup_imports_no_tests_or_scripts():
+    """Test that building the app doesn't import the test suite, the
+    scripts or optional front ends, as config.scan() used to."""
+    import subprocess
+    import sys
+    code = (
+        "import sys; from learning_journal_db import main; "
+        "main({}, **{'sqlalchemy.url': 'sqlite://'}); "
+        "print(' '.join(sorted(m for m in sys.modules if m.startswith(("
+        "'learning_journal_db.tests', 'learning_journal_db.scripts', "
+        "'learning_journal_db.asgi', 'pytest')))))")
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert output.strip() == b''
+
+
+def test_load_templates_fills_bytecode_cache(tmpdir):
+    """Test that every template, including the layout they extend, is
+    compiled into the bytecode cache directory."""
+    from learning_journal_db import main
+    from .templating import get_environment, load_templates, template_names
+    cache = tmpdir.join('jinja2')
+    settings = dict(DB_SETTINGS, **{
+        'jinja2.bytecode_caching': 'true',
+        'jinja2.bytecode_caching_directory': str(cache)})
+    app = main({}, **settings)
+    env = get_environment(app.registry)
+    loaded = load_templates(env)
+    # The layout is loaded once under the name of each page extending it.
+    assert loaded > len(template_names())
+    assert len(cache.listdir()) == loaded
+    names = [key[1] for key in env.cache.keys()]
+    assert ('layout.jinja2@@FROM_PARENT@@'
+            'learning_journal_db:templates/login.jinja2') in names
+
+
+def test_preloaded_templates_render_without_loading(monkeypatch):
+    """Test that with templates.preload no template is read on a request."""
+    from learning_journal_db import main
+    from webtest import TestApp
+    from .templating import get_environment
+    app = main({}, **dict(DB_SETTINGS, **{'templates.preload': 'true'}))
+    env = get_environment(app.registry)
+
+    def get_source(environment, name):
+        raise AssertionError('%s loaded on a request' % name)
+    monkeypatch.setattr(env.loader, 'get_source', get_source)
+    response = TestApp(app).get('/login', status=200)
+    assert 'login' in response.text.lower()
+
+
+def test_rerender_bodies_updates_stale_rows(file_session_factory):
+    """Test that render_bodies renders rows made by an older renderer,
+    leaving current rows and entry versions alone."""
+    from .scripts.renderbodies import rerender_bodies
+    session = file_session_factory()
+    session.add_all([MyModel(owner_id=TEST_USER.id,
+                             title=str(i), body=u'*%d*' % i)
+                     for i in range(5)])
+    current = rendered_entry('current', u'current')
+    current.body_html = u'kept'
+    session.add(current)
+    session.commit()
+    edited = [e.updated_at
+              for e in session.query(MyModel).order_by(MyModel.id)]
+    engine = session.get_bind()
+    assert rerender_bodies(engine, workers=2, batch_size=2) == 5
+    assert rerender_bodies(engine, workers=2, batch_size=2) == 0
+    session.expire_all()
+    entries = session.query(MyModel).order_by(MyModel.id).all()
+    assert entries[0].body_html == u'<p><em>0</em></p>'
+    assert (entries[0].excerpt, entries[0].word_count) == (u'0', 1)
+    assert all(e.body_html_version == RENDERER_VERSION for e in entries)
+    assert [e.version for e in entries] == [1] * 6
+    assert [e.updated_at for e in entries] == edited
+    assert entries[-1].body_html == u'kept'
+    session.close()
+
+
+def test_render_bodies_keeps_concurrent_edits(file_session_factory):
+    """Test that an entry edited between the read and the write of a
+    batch keeps the HTML of its new body."""
+    from .scripts.renderbodies import render_batch, stale_batches, \
+        write_batch
+    session = file_session_factory()
+    session.add_all([MyModel(owner_id=TEST_USER.id, title=title, body=body)
+                     for title, body in [(u'a', u'*old*'), (u'b', u'b')]])
+    session.commit()
+    engine = session.get_bind()
+    rendered = render_batch(next(stale_batches(engine)))
+    edited = session.query(MyModel).filter_by(title=u'a').one()
+    edited.set_body(u'**new**')
+    session.commit()
+    write_batch(engine, rendered)
+    session.expire_all()
+    entries = session.query(MyModel).order_by(MyModel.id).all()
+    assert entries[0].body_html == u'<p><strong>new</strong></p>'
+    assert entries[0].excerpt == u'new'
+    assert entries[1].body_html == u'<p>b</p>'
+    session.close()
+
+
+def test_render_bodies_changes_list_validators(file_session_factory):
+    """Test that list pages cached before render_bodies rewrote their
+    excerpts are not answered with a 304 after it."""
+    from .scripts.renderbodies import rerender_bodies
+    session = file_session_factory()
+    session.add(MyModel(owner_id=TEST_USER.id, title=u'a', body=u'*a*'))
+    session.commit()
+    request = dummy_http_request(session)
+    lists(request)
+    etag = request.response.headers['ETag']
+    assert rerender_bodies(session.get_bind(), workers=1) == 1
+    session.expire_all()
+    request = dummy_http_request(session)
+    request.headers['If-None-Match'] = etag
+    assert lists(request)['entries'][0].excerpt == u'a'
+    assert request.response.headers['ETag'] != etag
+    session.close()
+
+
+def test_stylesheet_files_are_committed():
+    """Test that every file base.css links, such as the web font, is in
+    static/ rather than fetched from elsewhere at deploy time."""
+    from .assets import STATIC_DIR
+    from .scripts.buildassets import CSS_URL
+    with open(os.path.join(STATIC_DIR, 'base.css')) as f:
+        urls = [url for quote, url in CSS_URL.findall(f.read())]
+    assert 'fonts/fira-sans-400.woff2' in urls
+    for url in urls:
+        assert os.path.isfile(os.path.join(STATIC_DIR, url))
+
+
+def test_build_assets_hashes_and_precompresses(tmpdir):
+    """Test that built assets get hashed names, CSS points at the hashed
+    fonts, and text files get smaller gzip and brotli variants."""
+    import brotli
+    import gzip
+    from .scripts.buildassets import build_assets
+    tmpdir.join('fonts', 'font.woff2').write_binary(b'wOF2' * 10,
+                                                     ensure=True)
+    tmpdir.join('base.css').write(
+        "@font-face { src: url('fonts/font.woff2') format('woff2'); }\n"
+        "body { color: black; }\n" * 20)
+    manifest = build_assets(str(tmpdir))
+    assert sorted(manifest) == ['base.css', 'fonts/font.woff2']
+    assert manifest['fonts/font.woff2'].startswith('build/fonts/font.')
+    css = tmpdir.join(manifest['base.css']).read_binary()
+    assert manifest['fonts/font.woff2'][len('build/'):].encode() in css
+    assert gzip.decompress(
+        tmpdir.join(manifest['base.css'] + '.gz').read_binary()) == css
+    assert brotli.decompress(
+        tmpdir.join(manifest['base.css'] + '.br').read_binary()) == css
+    assert not tmpdir.join(manifest['fonts/font.woff2'] + '.gz').exists()
+    assert json.loads(tmpdir.join('build', 'manifest.json').read()) == (
+        manifest)
+    assert build_assets(str(tmpdir)) == manifest
+
+
+@pytest.fixture()
+def built_assets():
+    """Build the package's static assets; remove them afterwards unless
+    they were there before."""
+    import shutil
+    from .assets import BUILD_DIR, STATIC_DIR
+    from .scripts.buildassets import build_assets
+    build_dir = os.path.join(STATIC_DIR, BUILD_DIR)
+    existed = os.path.exists(build_dir)
+    yield build_assets()
+    if not existed:
+        shutil.rmtree(build_dir)
+
+
+ASSETS_SCRIPT = """
+import json, sys
+from webob import Request
+from learning_journal_db import main
+app = main({}, **{'sqlalchemy.url': 'sqlite://'})
+css_url = '/static/' + sys.argv[1]
+built = Request.blank(css_url, headers={'Accept-Encoding': 'br, gzip'}
+                      ).get_response(app)
+plain = Request.blank('/static/base.css').get_response(app)
+print(json.dumps({
+    'linked': css_url in Request.blank('/login').get_response(app).text,
+    'encoding': built.headers.get('Content-Encoding'),
+    'cache_control': built.headers['Cache-Control'],
+    'vary': built.headers.get('Vary'),
+    'plain_cache_control': plain.headers['Cache-Control'],
+}))
+"""
+
+
+def test_built_assets_are_immutable_and_precompressed(built_assets):
+    """Test that pages link hashed assets, served compressed with a
+    one-year immutable Cache-Control."""
+    # In a subprocess: pkg_resources can't serve files from modules
+    # imported through pytest's assertion rewriting.
+    import subprocess
+    import sys
+    output = subprocess.check_output(
+        [sys.executable, '-c', ASSETS_SCRIPT, built_assets['base.css']],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        env=dict(os.environ, AUTH_SECRET='test'))
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    assert result == {
+        'linked': True,
+        'encoding': 'br',
+        'cache_control': 'max-age=31536000, public, immutable',
+        'vary': 'Accept-Encoding',
+        'plain_cache_control': 'max-age=3600',
+    }
+
+
+def compressing_tween(handler, **settings):
+    from pyramid.registry import Registry
+    from .compression import compression_tween_factory
+    registry = Registry()
+    registry.settings = settings
+    return compression_tween_factory(handler, registry)
+
+
+def compression_request(accept_encoding=None):
+    from pyramid.request import Request
+    headers = {}
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
+    return Request.blank('/', headers=headers)
+
+
+@pytest.mark.parametrize('accept, encoding', [
+    ('gzip, deflate', 'gzip'),
+    ('gzip, br', 'br'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('identity', None),
+    (None, None),
+])
+def test_compression_negotiates_encoding(accept, encoding):
+    """Test that the tween uses the best encoding the client accepts."""
+    import brotli
+    import gzip
+    from pyramid.response import Response
+    body = b'<p>journal entry</p>' * 200
+    tween = compressing_tween(
+        lambda request: Response(body, content_type='text/html'))
+    response = tween(compression_request(accept))
+    assert response.content_encoding == encoding
+    assert response.vary == ('Accept-Encoding',)
+    decode = {'br': brotli.decompress, 'gzip': gzip.decompress,
+              None: lambda data: data}[encoding]
+    assert decode(response.body) == body
+
+
+def test_compression_streams_app_iter():
+    """Test that a streamed body is compressed chunk by chunk as it is
+    iterated, never all at once."""
+    import zlib
+    from pyramid.response import Response
+    produced = []
+
+    def chunks():
+        for i in range(100):
+            chunk = os.urandom(1024)
+            produced.append(chunk)
+            yield chunk
+
+    tween = compressing_tween(lambda request: Response(
+        app_iter=chunks(), content_type='application/x-ndjson'))
+    response = tween(compression_request('gzip'))
+    assert response.content_length is None
+    app_iter = iter(response.app_iter)
+    first = next(app_iter)
+    assert len(produced) < 100
+    data = zlib.decompress(first + b''.join(app_iter), 16 + zlib.MAX_WBITS)
+    assert data == b''.join(produced)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'body': b'small', 'content_type': 'text/html'},
+    {'body': b'x' * 4096, 'content_type': 'image/png'},
+    {'body': b'x' * 4096, 'content_type': 'application/zip'},
+    {'body': b'x' * 4096, 'content_type': 'text/css',
+     'content_encoding': 'br'},
+])
+def test_compression_skips_small_or_encoded_bodies(kwargs):
+    """Test that small, binary and already encoded bodies are sent as
+    they are."""
+    from pyramid.response import Response
+    encoding = kwargs.get('content_encoding')
+    tween = compressing_tween(lambda request: Response(**kwargs),
+                              **{'compression.min_size': '1024'})
+    response = tween(compression_request('gzip, br'))
+    assert response.content_encoding == encoding
+    assert response.body == kwargs['body']
+
+
+def test_compression_weakens_etag():
+    """Test that compressed responses carry a weak ETag."""
+    from pyramid.response import Response
+    tween = compressing_tween(lambda request: Response(
+        b'x' * 4096, content_type='text/html', etag='entry-1-1'))
+    response = tween(compression_request('gzip'))
+    assert response.headers['ETag'] == 'W/"entry-1-1"'
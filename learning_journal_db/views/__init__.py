@@ -0,0 +1,76 @@
+"""
+View registration.
+
+The views are registered here explicitly rather than found by
+``config.scan()``, which imports every module of the package at startup,
+the command line scripts and the test suite (with pytest) included.
+"""
+from pyramid.renderers import JSON
+
+from .admin import metrics, render_cache_stats
+from .api import create_entries, update_entries
+from .default import (
+    archive,
+    create,
+    detail,
+    export,
+    history,
+    home,
+    lists,
+    login,
+    logout,
+    search,
+    tag,
+    tags,
+    update,
+    )
+from .notfound import notfound_view
+
+
+# Asset specs rather than names relative to this package, which
+# pyramid_jinja2 would first look up (and miss) on every render.
+TEMPLATES = 'learning_journal_db:templates/'
+
+
+def includeme(config):
+    # No whitespace between tokens: API batches can be large.
+    config.add_renderer('compact_json', JSON(separators=(',', ':')))
+    config.add_view(home, route_name='home')
+    config.add_view(login, route_name='login',
+                    renderer=TEMPLATES + 'login.jinja2')
+    config.add_view(logout, route_name='logout', permission='secret')
+    config.add_view(lists, route_name='lists',
+                    renderer=TEMPLATES + 'home_page.jinja2',
+                    permission='secret')
+    config.add_view(search, route_name='search',
+                    renderer=TEMPLATES + 'search.jinja2', permission='secret')
+    config.add_view(archive, route_name='archive',
+                    renderer=TEMPLATES + 'archive.jinja2',
+                    permission='secret')
+    config.add_view(tags, route_name='tags',
+                    renderer=TEMPLATES + 'tags.jinja2', permission='secret')
+    config.add_view(tag, route_name='tag',
+                    renderer=TEMPLATES + 'tag.jinja2', permission='secret')
+    config.add_view(create, route_name='create',
+                    renderer=TEMPLATES + 'new_entry.jinja2',
+                    permission='secret')
+    config.add_view(detail, route_name='detail',
+                    renderer=TEMPLATES + 'single_entry.jinja2',
+                    permission='secret')
+    config.add_view(export, route_name='export', permission='secret')
+    config.add_view(update, route_name='update',
+                    renderer=TEMPLATES + 'edit_entry.jinja2',
+                    permission='secret')
+    config.add_view(history, route_name='history',
+                    renderer=TEMPLATES + 'history.jinja2', permission='secret')
+    config.add_view(create_entries, route_name='api_entries',
+                    request_method='POST', renderer='compact_json',
+                    permission='secret')
+    config.add_view(update_entries, route_name='api_entries',
+                    request_method='PATCH', renderer='compact_json',
+                    permission='secret')
+    config.add_view(render_cache_stats, route_name='render_cache_stats',
+                    renderer='json', permission='admin')
+    config.add_view(metrics, route_name='metrics', permission='admin')
+    config.add_notfound_view(notfound_view,
+                             renderer=TEMPLATES + '404.jinja2')
@@ -0,0 +1,27 @@
+from pyramid.response import Response
+
+
+def render_cache_stats(request):
+    """Return the hit/miss/eviction counters of the render cache."""
+    cache = request.registry.get('render_cache')
+    if cache is None:
+        return {}
+    return cache.stats()
+
+
+def metrics(request):
+    """Return the request metrics in the Prometheus text format."""
+    registry_metrics = request.registry.get('metrics')
+    if registry_metrics is None:
+        return Response('', content_type='text/plain')
+    extra = []
+    cache = request.registry.get('render_cache')
+    if cache is not None:
+        stats = cache.stats()
+        for key, metric_type in [('hits', 'counter'), ('misses', 'counter'),
+                                 ('evictions', 'counter'),
+                                 ('entries', 'gauge'), ('bytes', 'gauge')]:
+            extra.append(('journal_render_cache_%s' % key, metric_type,
+                          'Render cache %s.' % key, stats[key]))
+    return Response(registry_metrics.render(extra),
+                    content_type='text/plain', charset='utf-8')
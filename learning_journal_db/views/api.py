@@ -0,0 +1,152 @@
+"""
+JSON API for writing many entries per request.
+
+``POST /api/entries`` creates entries and ``PATCH /api/entries`` edits
+them; both take ``{"entries": [...]}`` and answer with the id and new
+version of each entry, in order. A batch is checked completely before
+anything is written and then written with bulk ORM operations in the
+request's single transaction: either every entry is saved or none is.
+"""
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPConflict,
+    HTTPRequestEntityTooLarge,
+    HTTPUnprocessableEntity,
+)
+from sqlalchemy.orm.exc import StaleDataError
+import zope.sqlalchemy
+
+from ..cache import invalidate_after_commit
+from ..journal_io import record_to_values
+from ..markup import rendered_values
+from ..models import EntryRevision, MyModel
+from ..models.archive import add_to_archive
+
+
+MAX_BATCH_SIZE = 500
+
+
+def api_error(exception_class, message, index=None):
+    """Return an HTTP exception with a JSON body describing the error."""
+    error = {'error': message}
+    if index is not None:
+        error['index'] = index
+    return exception_class(json_body=error)
+
+
+def batch_items(request):
+    """Return the list of entries posted as ``{"entries": [...]}``."""
+    try:
+        data = request.json_body
+    except ValueError:
+        raise api_error(HTTPBadRequest, 'Request body is not valid JSON.')
+    items = data.get('entries') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise api_error(HTTPBadRequest, 'Expected {"entries": [...]}.')
+    if len(items) > MAX_BATCH_SIZE:
+        raise api_error(HTTPRequestEntityTooLarge,
+                        'At most %d entries per request.' % MAX_BATCH_SIZE)
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise api_error(HTTPBadRequest, 'Entries must be objects.', index)
+    return items
+
+
+def _check_text(item, name, index, required=True):
+    value = item.get(name)
+    if value is None and not required:
+        return
+    if not isinstance(value, str) or not value:
+        raise api_error(HTTPBadRequest, '"%s" must be a non-empty string.'
+                        % name, index)
+
+
+def create_entries(request):
+    """
+    Create the posted entries for the user, given like the records of the
+    export: "title" and "body", optionally "created_at" and "updated_at".
+    """
+    items = batch_items(request)
+    rows = []
+    for index, item in enumerate(items):
+        _check_text(item, 'title', index)
+        _check_text(item, 'body', index)
+        try:
+            rows.append(record_to_values(item, request.user.id))
+        except ValueError as e:
+            raise api_error(HTTPBadRequest, str(e), index)
+    dbsession = request.dbsession
+    # return_defaults fills in the new ids.
+    dbsession.bulk_insert_mappings(MyModel, rows, return_defaults=True)
+    add_to_archive(dbsession, request.user.id,
+                   [row['created_at'] for row in rows])
+    # Nothing went through the unit of work: make sure pyramid_tm commits.
+    zope.sqlalchemy.mark_changed(dbsession)
+    request.response.status = 201
+    return {'entries': [{'id': row['id'], 'version': row['version']}
+                        for row in rows]}
+
+
+def update_entries(request):
+    """
+    Edit the user's entries given by "id", setting "title" and/or "body".
+
+    With "version", the edit is refused (409) unless the entry is still
+    at that version. The versions being replaced are kept as
+    EntryRevisions, as with the edit form.
+    """
+    items = batch_items(request)
+    ids = []
+    for index, item in enumerate(items):
+        entry_id = item.get('id')
+        if not isinstance(entry_id, int) or isinstance(entry_id, bool):
+            raise api_error(HTTPBadRequest, '"id" must be an integer.', index)
+        if entry_id in ids:
+            raise api_error(HTTPBadRequest, 'Entry %d is given twice.'
+                            % entry_id, index)
+        ids.append(entry_id)
+        _check_text(item, 'title', index, required=False)
+        _check_text(item, 'body', index, required=False)
+
+    dbsession = request.dbsession
+    current = dict((row.id, row) for row in dbsession.query(
+        MyModel.id, MyModel.title, MyModel.body, MyModel.version,
+        MyModel.updated_at).filter(
+        MyModel.owner_id == request.user.id, MyModel.id.in_(ids)))
+    versions = dict((entry_id, row.version)
+                    for entry_id, row in current.items())
+    revisions = []
+    changes = []
+    for index, item in enumerate(items):
+        entry = current.get(item['id'])
+        if entry is None:
+            raise api_error(HTTPUnprocessableEntity,
+                            'No entry %d.' % item['id'], index)
+        if item.get('version', entry.version) != entry.version:
+            raise api_error(HTTPConflict, 'Entry %d is at version %d.'
+                            % (entry.id, entry.version), index)
+        values = {}
+        if item.get('title', entry.title) != entry.title:
+            values['title'] = item['title']
+        if item.get('body', entry.body) != entry.body:
+            values.update(rendered_values(item['body']))
+            values['body'] = item['body']
+        if values:
+            revisions.append(EntryRevision.from_entry(entry))
+            # The current version goes in the WHERE clause, and is bumped.
+            values.update(id=entry.id, version=entry.version)
+            changes.append(values)
+            versions[entry.id] += 1
+
+    if changes:
+        dbsession.bulk_save_objects(revisions)
+        try:
+            dbsession.bulk_update_mappings(MyModel, changes)
+        except StaleDataError:
+            # Edited by another request since it was read above.
+            raise api_error(HTTPConflict, 'Entries changed concurrently.')
+        zope.sqlalchemy.mark_changed(dbsession)
+        for values in changes:
+            invalidate_after_commit(request, values['id'])
+    return {'entries': [{'id': entry_id, 'version': versions[entry_id]}
+                        for entry_id in ids]}
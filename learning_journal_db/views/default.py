@@ -1,14 +1,39 @@
+import datetime
+import functools
+import hashlib
+import math
+
+from pyramid.renderers import render
 from pyramid.response import Response
-from pyramid.view import view_config
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.exc import DBAPIError
-from ..models import MyModel
-from pyramid.httpexceptions import HTTPFound
-import email.utils
+from sqlalchemy.orm import load_only
+from ..cache import invalidate_after_commit
+from ..journal_io import iter_jsonl, iter_zip
+from ..models import EntryRevision, EntryTag, MyModel, Tag
+from ..models.tag import (
+    entry_tag_names,
+    parse_tags,
+    set_entry_tags,
+    tag_cloud,
+    )
+from ..models.archive import add_to_archive, archive_months
+from ..models.search import search_entries
+from pyramid.httpexceptions import HTTPFound, HTTPNotFound, HTTPNotModified
+from webob.datetime_utils import UTC, parse_date
+from webob.etag import ETagMatcher
 from pyramid.security import remember, forget
-from learning_journal_db.security import check_credentials
+from learning_journal_db.security import (
+    check_credentials,
+    login_allowed,
+    reset_login_attempts,
+)
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+TAG_CLOUD_SIZE = 100
 
 
-@view_config(route_name='home')
 def home(request):
     if request.authenticated_userid:
         return HTTPFound(request.route_url('lists'))
@@ -16,13 +41,17 @@ def home(request):
         return HTTPFound(request.route_url('login'))
 
 
-@view_config(route_name='login', renderer='templates/login.jinja2')
 def login(request):
     msg = ''
     if request.method == 'POST':
         username = request.params.get('username', '')
         password = request.params.get('password', '')
-        if check_credentials(username, password):
+        if not login_allowed(request, username):
+            request.response.status = 429
+            msg = "Too many login attempts. Please try again later."
+        elif check_credentials(request.dbsession, username, password,
+                               request.registry.get('password_verifier')):
+            reset_login_attempts(request, username)
             headers = remember(request, username)
             return HTTPFound(request.route_url('lists'), headers=headers)
         else:
@@ -30,7 +59,6 @@ def login(request):
     return {'msg': msg}
 
 
-@view_config(route_name='logout', permission='secret')
 def logout(request):
     headers = forget(request)
     return HTTPFound(request.route_url('login'), headers=headers)
@@ -39,30 +67,326 @@ def logout(request):
 def add_new_model(request):
     """
     Add new model to db using the values from the form.
-    A helper function for update() and create()."""
+    A helper function for create()."""
     new_title = request.POST['title']
     new_body = request.POST['body']
-    new_date = email.utils.formatdate(usegmt=True)
-    entry = MyModel(title=new_title, body=new_body, date=new_date)
+    entry = MyModel(title=new_title, owner_id=request.user.id)
+    entry.set_body(new_body)
     request.dbsession.add(entry)
+    # The archive and tag links need the entry's id and created_at.
+    request.dbsession.flush()
+    add_to_archive(request.dbsession, entry.owner_id, [entry.created_at])
+    tags = parse_tags(request.POST.get('tags'))
+    if tags:
+        set_entry_tags(request.dbsession, entry, tags)
+    return {'entry': entry}
+
+
+def update_model(request, entry):
+    """
+    Update an existing model in place using the values from the form.
+    The version being replaced is kept as an EntryRevision.
+    Tags are only changed when the form has a "tags" field.
+    A helper function for update()."""
+    new_title = request.POST['title']
+    new_body = request.POST['body']
+    changed = False
+    if new_title != entry.title or new_body != entry.body:
+        request.dbsession.add(EntryRevision.from_entry(entry))
+        entry.title = new_title
+        entry.set_body(new_body)
+        changed = True
+    if 'tags' in request.POST and set_entry_tags(
+            request.dbsession, entry, parse_tags(request.POST['tags'])):
+        # The entry page shows the tags: make this a new version of it.
+        entry.updated_at = datetime.datetime.utcnow()
+        changed = True
+    if changed:
+        invalidate_after_commit(request, entry.id)
     return {'entry': entry}
 
 
-@view_config(
-    route_name='lists', renderer='templates/home_page.jinja2',
-    permission='secret'
-)
 def lists(request):
-    """Return all the entries from the database."""
-    query = request.dbsession.query(MyModel)
-    entries = query.all()
-    return {"entries": entries}
+    """
+    Return one page of the user's entries, newest first.
+
+    Pages are addressed by keyset cursors rather than offsets:
+    "?after=<id>" continues past the entry with that id, "?before=<id>"
+    goes back to the entries preceding it. Entries are ordered by
+    (created_at, id), a range of the (owner_id, created_at, id) index,
+    and only the columns shown on the list page are loaded (the excerpt
+    and word count are stored when an entry is saved, never worked out
+    from its body), so a page costs the same however large the table is.
+
+    Responses carry an ETag and Last-Modified derived from the newest
+    entry id, edit time and render time, each read from the end of its
+    own index, so a client whose copy is current gets a 304 after three
+    index seeks.
+    """
+    limit, after, before = _page_params(request)
+    if _list_not_modified(request, limit, after, before):
+        return _not_modified_response(request)
+    query = request.dbsession.query(MyModel).filter(
+        MyModel.owner_id == request.user.id).options(_list_columns())
+    page = _keyset_page(request, query, MyModel.created_at, MyModel.id,
+                        limit, after, before)
+    page['archive'] = _archive_sidebar(request)
+    return page
+
+
+def archive(request):
+    """
+    Return one page of the user's entries written in one month, newest
+    first.
+
+    Paging and validators work as in lists(); the month is a range of the
+    (owner_id, created_at, id) index.
+    """
+    year = int(request.matchdict['year'])
+    month = int(request.matchdict['month'])
+    # December 9999 would end in a year datetime can't hold.
+    if (year < 1 or not 1 <= month <= 12 or
+            (year, month) == (datetime.MAXYEAR, 12)):
+        raise HTTPNotFound()
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        end = datetime.datetime(year + 1, 1, 1)
+    else:
+        end = datetime.datetime(year, month + 1, 1)
+    limit, after, before = _page_params(request)
+    if _list_not_modified(request, limit, after, before, year, month):
+        return _not_modified_response(request)
+    query = request.dbsession.query(MyModel).filter(
+        MyModel.owner_id == request.user.id,
+        MyModel.created_at >= start, MyModel.created_at < end
+    ).options(_list_columns())
+    page = _keyset_page(request, query, MyModel.created_at, MyModel.id,
+                        limit, after, before)
+    page.update(year=year, month=month, title=start.strftime('%B %Y'),
+                archive=_archive_sidebar(request))
+    return page
+
+
+def _archive_sidebar(request):
+    """
+    Return (label, year, month, entry count) of the months the user wrote
+    in, newest first, from the archive rollup.
+    """
+    return [
+        (datetime.date(year, month, 1).strftime('%B %Y'), year, month,
+         count)
+        for year, month, count in archive_months(request.dbsession,
+                                                 request.user.id)
+    ]
+
+
+def tag(request):
+    """
+    Return one page of the entries with the tag "name", newest first.
+
+    Paging and validators work as in lists(); the entries are read in
+    order from the (tag_id, created_at, entry_id) index of the tag links.
+    """
+    name = request.matchdict['name']
+    found = request.dbsession.query(Tag.id).filter(
+        Tag.owner_id == request.user.id, Tag.name == name).first()
+    if found is None:
+        raise HTTPNotFound()
+    limit, after, before = _page_params(request)
+    if _list_not_modified(request, limit, after, before, name):
+        return _not_modified_response(request)
+    query = request.dbsession.query(MyModel).join(
+        EntryTag, EntryTag.entry_id == MyModel.id).filter(
+        EntryTag.tag_id == found.id).options(_list_columns())
+    page = _keyset_page(request, query, EntryTag.created_at,
+                        EntryTag.entry_id, limit, after, before)
+    page['tag'] = name
+    return page
+
+
+def tags(request):
+    """Display the tag cloud: the most used tags with their counts."""
+    cloud = tag_cloud(request.dbsession, request.user.id, TAG_CLOUD_SIZE)
+    most = max([count for name, count in cloud] or [1])
+    # Five sizes, on a log scale so a few big tags don't flatten the rest.
+    return {'tags': [
+        (name, count, 1 + int(4 * math.log(count) / math.log(most))
+         if most > 1 else 1)
+        for name, count in sorted(cloud)
+    ]}
+
+
+def _page_params(request):
+    """Return the limit, after and before parameters of a list page."""
+    limit = _int_param(request, 'limit', DEFAULT_PAGE_SIZE)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, _int_param(request, 'after'), _int_param(request, 'before')
+
+
+def _list_columns():
+    """The columns shown on list pages."""
+    return load_only(MyModel.id, MyModel.title, MyModel.created_at,
+                     MyModel.excerpt, MyModel.word_count,
+                     MyModel.reading_minutes)
+
+
+def _list_not_modified(request, *page):
+    """
+    Set the validators of a list page, identified by ``page``, and
+    return True if the client's copy is current.
+
+    They come from the user's newest entry id, edit time and render
+    time: any new or edited entry changes every list page, and so does
+    render_bodies rewriting excerpts without editing the entries.
+    """
+    # One subquery per max, so that each is a single lookup at the end
+    # of its own (owner_id, column) index.
+    max_id, edited, rendered = request.dbsession.query(*[
+        select(func.max(column)).where(
+            MyModel.owner_id == request.user.id).scalar_subquery()
+        for column in (MyModel.id, MyModel.updated_at, MyModel.rendered_at)
+    ]).one()
+    etag = hashlib.sha1(repr((
+        request.authenticated_userid, max_id, edited, rendered,
+    ) + page).encode('utf-8')).hexdigest()
+    last_modified = max(edited, rendered) if rendered else edited
+    return _not_modified(request, etag, last_modified)
+
+
+def _keyset_page(request, query, created_at, entry_id, limit, after,
+                 before):
+    """
+    Return one page of the entries of ``query`` ordered by the columns
+    ``created_at`` and ``entry_id``, newest first, with its cursors.
+    """
+    if before is not None:
+        query = _keyset_filter(request, query, before, False, created_at,
+                               entry_id)
+        query = query.order_by(created_at.asc(), entry_id.asc())
+    else:
+        if after is not None:
+            query = _keyset_filter(request, query, after, True, created_at,
+                                   entry_id)
+        query = query.order_by(created_at.desc(), entry_id.desc())
+    return _page(query, limit, after, before, lambda entry: entry.id,
+                 'entries')
+
+
+def _page(query, limit, after, before, cursor, name):
+    """
+    Return the page of at most ``limit`` rows of ``query``, already
+    filtered and ordered for the ``after`` or ``before`` cursor, under
+    ``name``, with the cursors (given by ``cursor(row)``) of the pages
+    around it.
+    """
+    # Fetch one extra row to find out whether another page follows.
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+
+    next_after = prev_before = None
+    if rows:
+        if has_more or before is not None:
+            next_after = cursor(rows[-1])
+        if after is not None or (before is not None and has_more):
+            prev_before = cursor(rows[0])
+    return {
+        name: rows,
+        "limit": limit,
+        "next_after": next_after,
+        "prev_before": prev_before,
+    }
+
+
+def search(request):
+    """
+    Return one page of entries matching "?q=", best match first.
+
+    Results come from the database's full-text index with a highlighted
+    snippet each; entry bodies are never loaded.
+    """
+    terms = request.GET.get('q', '').strip()
+    limit = _int_param(request, 'limit', DEFAULT_PAGE_SIZE)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    page = max(1, _int_param(request, 'page', 1))
+    results = []
+    if terms:
+        results = search_entries(request.dbsession, request.user.id, terms,
+                                 limit + 1, offset=(page - 1) * limit)
+    has_more = len(results) > limit
+    return {
+        "q": terms,
+        "results": results[:limit],
+        "limit": limit,
+        "page": page,
+        "next_page": page + 1 if has_more else None,
+        "prev_page": page - 1 if page > 1 else None,
+    }
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Set the response validators and check them against the request.
+
+    Return True if the client's cached copy, identified by If-None-Match
+    or If-Modified-Since, is still current. ``last_modified`` is a naive
+    UTC datetime or None.
+    """
+    response = request.response
+    response.etag = etag
+    response.cache_control = 'private, no-cache'
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=UTC)
+        response.last_modified = last_modified
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in ETagMatcher.parse(if_none_match, strong=False)
+    if_modified_since = parse_date(request.headers.get('If-Modified-Since'))
+    if if_modified_since is not None and last_modified is not None:
+        return last_modified <= if_modified_since
+    return False
+
+
+def _not_modified_response(request):
+    """Return a 304 carrying the validators set by _not_modified()."""
+    headers = [(name, value) for name, value in request.response.headerlist
+               if name in ('ETag', 'Last-Modified', 'Cache-Control')]
+    return HTTPNotModified(headers=headers)
+
+
+def _keyset_filter(request, query, cursor_id, older,
+                   created_at=MyModel.created_at, entry_id=MyModel.id):
+    """
+    Restrict ``query`` to entries older (or newer) than the entry with id
+    ``cursor_id`` in (created_at, id) order, given by the columns
+    ``created_at`` and ``entry_id``.
+    """
+    cursor = request.dbsession.query(MyModel.created_at).filter(
+        MyModel.id == cursor_id).first()
+    if cursor is None:
+        return query
+    cursor_created_at = cursor[0]
+    if older:
+        return query.filter(or_(
+            created_at < cursor_created_at,
+            and_(created_at == cursor_created_at, entry_id < cursor_id)
+        ))
+    return query.filter(or_(
+        created_at > cursor_created_at,
+        and_(created_at == cursor_created_at, entry_id > cursor_id)
+    ))
+
+
+def _int_param(request, name, default=None):
+    """Return query string parameter ``name`` as an int, or ``default``."""
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return default
 
 
-@view_config(
-    route_name='create', renderer='templates/new_entry.jinja2',
-    permission='secret'
-)
 def create(request):
     """
     Display an empty form on "GET".
@@ -74,6 +398,7 @@ def create(request):
     if request.method == 'GET':
         session['title'] = ''
         session['body'] = ''
+        session['tags'] = ''
         return {'session': session, 'error_msg': error_msg}
     if request.method == 'POST':
         if request.POST['title'] != '' and request.POST['body'] != '':
@@ -82,39 +407,98 @@ def create(request):
         else:
             session['title'] = request.POST['title']
             session['body'] = request.POST['body']
+            session['tags'] = request.POST.get('tags', '')
             error_msg = "Title and Notes fields require at least 1 character."
             return {'session': session, 'error_msg': error_msg}
 
 
-@view_config(
-    route_name='detail', renderer='templates/single_entry.jinja2',
-    permission='secret'
-)
 def detail(request):
-    """Display details of the entry with a particular id."""
+    """
+    Display details of the entry with a particular id.
+
+    The entry's version, renderer version and updated_at are looked up
+    first; if the client already has that version, a 304 is returned
+    without loading the body or rendering the page. Otherwise the page
+    comes from the render cache when it holds this version, and is
+    rendered and cached when not.
+    """
+    entry_id = int(request.matchdict['id'])
+    current = request.dbsession.query(
+        MyModel.version, MyModel.body_html_version, MyModel.updated_at
+    ).filter(MyModel.id == entry_id,
+             MyModel.owner_id == request.user.id).first()
+    if current is None:
+        raise HTTPNotFound()
+    # Re-rendering a body changes the page but not the entry's version.
+    version = (current.version, current.body_html_version)
+    last_modified = current.updated_at
+    etag = 'entry-%s-%s-%s' % ((entry_id,) + version)
+    if _not_modified(request, etag, last_modified):
+        return _not_modified_response(request)
+
+    cache = request.registry.get('render_cache')
+    if cache is not None:
+        body = cache.get(entry_id, version)
+        if body is not None:
+            request.response.body = body
+            return request.response
+
     query = request.dbsession.query(MyModel)
-    entry = query.filter(MyModel.id ==
-                         int(request.matchdict['id'])).first()
-    return {'entry': entry}
+    entry = query.filter(MyModel.id == entry_id).first()
+    tags = entry_tag_names(request.dbsession, entry_id)
+    if cache is None:
+        return {'entry': entry, 'tags': tags}
+    body = render('learning_journal_db:templates/single_entry.jinja2',
+                  {'entry': entry, 'tags': tags},
+                  request=request).encode('utf-8')
+    cache.put(entry_id, (entry.version, entry.body_html_version), body)
+    request.response.body = body
+    return request.response
+
+
+def export(request):
+    """
+    Stream every entry of the user as JSON Lines, optionally zipped.
+
+    The response body is a generator that reads the table in keyset
+    batches through its own session: pyramid_tm has already finished the
+    request's transaction by the time the server iterates it, no
+    connection is held while the client reads, and memory use stays flat
+    however big the journal is.
+    """
+    session_factory = functools.partial(
+        request.registry['dbsession_factory'], info={'read_only': True})
+    chunks = iter_jsonl(session_factory, owner_id=request.user.id)
+    if request.matchdict['ext'] == 'zip':
+        app_iter = iter_zip(chunks, 'journal.jsonl')
+        content_type = 'application/zip'
+    else:
+        app_iter = chunks
+        content_type = 'application/x-ndjson'
+    response = Response(app_iter=app_iter, content_type=content_type,
+                        charset=None)
+    response.content_disposition = (
+        'attachment; filename="journal.%s"' % request.matchdict['ext'])
+    response.cache_control = 'private, no-store'
+    return response
 
 
-@view_config(
-    route_name='update', renderer='templates/edit_entry.jinja2',
-    permission='secret'
-)
 def update(request):
     """
     Display details of particular entry on "GET".
-    Create a new model and return to the home_page on "POST".
+    Update the entry and return to the home_page on "POST".
     """
     session = {}
     error_msg = ''
 
     query = request.dbsession.query(MyModel)
-    entry = query.filter(MyModel.id ==
-                         int(request.matchdict['id'])).first()
+    entry = query.filter(MyModel.id == int(request.matchdict['id']),
+                         MyModel.owner_id == request.user.id).first()
+    if entry is None:
+        raise HTTPNotFound()
     session['title'] = entry.title
     session['body'] = entry.body
+    session['tags'] = ', '.join(entry_tag_names(request.dbsession, entry.id))
     session['id'] = request.matchdict['id']
 
     if request.method == 'GET':
@@ -122,8 +506,41 @@ def update(request):
 
     elif request.method == 'POST':
         if request.POST['title'] != '' and request.POST['body'] != '':
-            add_new_model(request)
+            update_model(request, entry)
             return HTTPFound(request.route_url('lists'))
         else:
             error_msg = "Title and Notes fields require at least 1 character."
             return {'entry': session, 'error_msg': error_msg}
+
+
+def history(request):
+    """
+    Display the earlier versions of the entry with a particular id, one
+    page at a time, newest first.
+
+    Pages are addressed like those of lists(), by the version numbers
+    they continue from, and read from the (entry_id, version) index; only
+    the revisions on the page are loaded and decompressed.
+    """
+    entry_id = int(request.matchdict['id'])
+    entry = request.dbsession.query(MyModel).options(
+        load_only(MyModel.id, MyModel.title, MyModel.version,
+                  MyModel.updated_at)
+    ).filter(MyModel.id == entry_id,
+             MyModel.owner_id == request.user.id).first()
+    if entry is None:
+        raise HTTPNotFound()
+    limit, after, before = _page_params(request)
+    query = request.dbsession.query(EntryRevision).filter(
+        EntryRevision.entry_id == entry_id)
+    version = EntryRevision.version
+    if before is not None:
+        query = query.filter(version > before).order_by(version.asc())
+    else:
+        if after is not None:
+            query = query.filter(version < after)
+        query = query.order_by(version.desc())
+    page = _page(query, limit, after, before,
+                 lambda revision: revision.version, 'revisions')
+    page['entry'] = entry
+    return page
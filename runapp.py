@@ -2,8 +2,19 @@ import os
 from paste.deploy import loadapp
 from waitress import serve
 
+from learning_journal_db.prefork import Arbiter
+
+
+def load_app():
+    return loadapp('config:production.ini', relative_to='.')
+
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app = loadapp('config:production.ini', relative_to='.')
-    serve(app, host='0.0.0.0', port=port)
\ No newline at end of file
+    # One process per core; with WEB_CONCURRENCY unset or 1 there is no
+    # parent process and the app is served as before.
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    if workers > 1:
+        Arbiter(load_app, '0.0.0.0', port, workers).run()
+    else:
+        serve(load_app(), host='0.0.0.0', port=port)
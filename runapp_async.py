@@ -0,0 +1,11 @@
+import os
+import uvicorn
+from pyramid.paster import get_appsettings
+from learning_journal_db.asgi import make_asgi_app
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    settings = get_appsettings('production.ini', name='learning_journal_db')
+    app = make_asgi_app({}, **settings)
+    uvicorn.run(app, host='0.0.0.0', port=port, proxy_headers=True)
@@ -20,10 +20,21 @@ requires = [
     'waitress',
     'psycopg2',
     'passlib',
+    'Markdown',
+    'nh3',
+    'Brotli',
     'requests',
     'ipython'
     ]
 
+# for the ASGI front end, learning_journal_db.asgi
+async_requires = [
+    'SQLAlchemy[asyncio]',
+    'asyncpg',
+    'aiosqlite',
+    'uvicorn',
+    ]
+
 tests_require = [
     'passlib',
     'WebTest >= 1.3.1',  # py3 compat
@@ -51,6 +62,7 @@ setup(name='learning_journal_db',
       zip_safe=False,
       extras_require={
           'testing': tests_require,
+          'async': async_requires,
       },
       install_requires=requires,
       entry_points="""\
@@ -58,5 +70,13 @@ setup(name='learning_journal_db',
       main = learning_journal_db:main
       [console_scripts]
       init_db = learning_journal_db.scripts.initializedb:main
+      migrate_db = learning_journal_db.scripts.migratedb:main
+      import_journal = learning_journal_db.scripts.bulkdata:import_main
+      export_journal = learning_journal_db.scripts.bulkdata:export_main
+      compile_templates = learning_journal_db.scripts.compiletemplates:main
+      render_bodies = learning_journal_db.scripts.renderbodies:main
+      build_assets = learning_journal_db.scripts.buildassets:main
+      add_user = learning_journal_db.scripts.adduser:main
+      rebuild_archive = learning_journal_db.scripts.rebuildarchive:main
       """,
       )